@@ -9,19 +9,31 @@ __copyright__ = '2021, Markdown Optimization'
 __credits__ = ['Suyash, Preetham, Rahul, Srikant, Suraj']
 
 
-import logging
+import asyncio
+import functools
+import json
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack, asynccontextmanager
 from datetime import timedelta
 
 
-from fastapi import FastAPI, status
+from fastapi import FastAPI, HTTPException, Request, Response, status
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from typing import Dict
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from src.jyotish.data_model import ItemClub as ItemClubV3_jyotish
 from src.jyotish.prediction_pipeline import PredictionPipeline
 from src.jyotish.requests_manager import RequestsManager
 from src.v3.data_model import ItemClub as ItemClubV3
 from src.v3.recommendation_pipeline import process_md_recommendation_pipeline
+from src.v3.sale_prediction import fetch_club_item_data
 
 from src.dotcom_prediction.data_model import ItemClub as ItemClub_dotcom_prediction
 from src.dotcom_prediction.prediction_pipeline import PredictionPipeline as PredictionPipeline_dotcom_prediction
@@ -29,31 +41,194 @@ from src.dotcom_prediction.requests_manager import RequestsManager as RequestsMa
 from src.dotcom_optimization.data_model import ItemClub as ItemClub_dotcom_optimization
 from src.dotcom_optimization.recommendation_pipeline import process_md_recommendation_pipeline as process_md_recommendation_pipeline_dotcom_optimization
 from src.config import Settings
+from src.jyotish.feature_snapshot import SnapshotFeatureStore
+from src.jyotish.model_refresher import model_refresher
+from src.metrics import metrics_registry, request_latency, observe_batch, count_no_reco_reason_codes, CONTENT_TYPE
+from src.log_config import get_logger
 from wmfs.feature_mart import FeatureMart
 # Set Logging Configurations
-logger = logging.getLogger(__name__)
-handler = logging.StreamHandler()
-logger.setLevel(logging.INFO)
-format_ = logging.Formatter('%(asctime)s - [%(name)s] - [%(levelname)s] - %(message)s')
-handler.setFormatter(format_)
-logger.addHandler(handler)
+logger = get_logger(__name__)
+
+
+def create_feature_store():
+    if Settings.feature_backend == 'snapshot':
+        return SnapshotFeatureStore(Settings.feature_snapshot_path)
+    Settings.setup_feature_store_credentials()
+    return FeatureMart(fs_name='fs_bq_bt', namespace='sams')
+
 
 # Initial FastAPI app
 app = FastAPI()
-Settings.setup_feature_store_credentials()
-feature_store= FeatureMart(fs_name='fs_bq_bt', namespace='sams')
+feature_store = create_feature_store()
+
+# Handlers are async and only wait on these executors, so that the event loop (and with it the health checks) is never
+# blocked by a long running plan. Feature Store I/O and CPU bound pipeline work get separate, explicitly sized pools.
+feature_io_executor = ThreadPoolExecutor(max_workers=Settings.api_feature_io_workers, thread_name_prefix='feature_io')
+pipeline_executor = ThreadPoolExecutor(max_workers=Settings.api_pipeline_workers, thread_name_prefix='pipeline')
+
+
+class EndpointLimiter():
+    """Limits the number of batches of an endpoint which are processed at the same time. Batches beyond the limit wait
+    in a queue of bounded length, batches arriving when the queue is full are rejected with 503 so that the caller can
+    retry instead of piling up latency."""
+
+    def __init__(self, name: str, max_concurrency: int, max_queued: int):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        self.waiting = 0
+        # Created lazily so that the semaphore is bound to the event loop of the server
+        self._semaphore = None
+
+    @asynccontextmanager
+    async def limit(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self._semaphore.locked() and self.waiting >= self.max_queued:
+            logger.warning(f"Rejecting request for {self.name}: {self.waiting} requests already queued")
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail=f"Too many requests queued for {self.name}, please retry later")
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+
+endpoint_limiters = {endpoint: EndpointLimiter(endpoint, max_concurrency, Settings.api_endpoint_max_queued)
+                     for endpoint, max_concurrency in Settings.api_endpoint_concurrency.items()}
+
+
+@asynccontextmanager
+async def serve_batch(endpoint: str, batch_size: int = None):
+    """Process a batch under the concurrency limit of the endpoint, recording its size and latency. Streamed batches
+    don't know their size up front, they record it with observe_batch once they are read."""
+    if batch_size is not None:
+        observe_batch(endpoint, batch_size)
+    with request_latency.time(endpoint=endpoint):
+        async with endpoint_limiters[endpoint].limit():
+            yield
+
+
+async def run_in_executor(executor: ThreadPoolExecutor, function, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(function, *args))
+
+
+def dump_json(content) -> bytes:
+    """Serialize a payload of JSON native objects, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(',', ':')).encode('utf-8')
+
+
+class FastJSONResponse(Response):
+    """JSON response which serializes the payload as it is. Routes returning it skip the jsonable_encoder pass of
+    FastAPI, so the payload must already be made of JSON native objects."""
+    media_type = 'application/json'
+
+    def render(self, content) -> bytes:
+        return dump_json(content)
+
+
+class BodyStreamingResponse(StreamingResponse):
+    """Streaming response whose body iterator reads the request body as it goes. StreamingResponse listens for the
+    client disconnecting on the channel the request body arrives on, which would swallow the body, so this one only
+    streams and a client which disconnects shows up as a failed send. The body iterator is closed and the background
+    task is run in any case, so that what the response holds is released even if it is never fully sent."""
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.stream_response(send)
+        finally:
+            try:
+                await self.body_iterator.aclose()
+            finally:
+                if self.background is not None:
+                    await self.background()
+
+
+def parse_ndjson_lines(lines: list, seen_request_ids: set):
+    """Parse NDJSON lines into ItemClub requests. Each line is an ItemClub object along with its request_id. Lines which
+    can't be parsed or repeat a request_id already seen in the stream are returned as error lines.
+    :param lines: List of (line number, line)
+    :param seen_request_ids: request_ids of the stream so far, updated with the ones of these lines
+    :return: (requests keyed by request_id, error lines)
+    """
+    chunk, errors = {}, []
+    for line_nbr, line in lines:
+        request_id = None
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict) or 'request_id' not in record:
+                raise ValueError("Each line must be a JSON object with a request_id")
+            request_id = str(record.pop('request_id'))
+            if request_id in seen_request_ids:
+                raise ValueError(f"Duplicate request_id {request_id}")
+            chunk[request_id] = ItemClubV3.parse_obj(record)
+            seen_request_ids.add(request_id)
+        except ValueError as e:
+            # Covers JSON decode and pydantic validation errors as well
+            errors.append(dict(request_id=request_id, line=line_nbr, status="FAILED", error=str(e)))
+    return chunk, errors
+
+
+async def iter_ndjson_lines(stream):
+    """Lines of an NDJSON body as they arrive, only the last partial line is buffered"""
+    buffer = b''
+    async for data in stream:
+        buffer += data
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+
+async def iter_ndjson_chunks(stream, chunk_size: int):
+    """Read the NDJSON body stream into chunks of at most chunk_size lines, which are parsed on the pipeline executor.
+    Only one chunk of raw lines is held at a time.
+    :return: Async generator of (requests of the chunk, error lines of the chunk, number of lines of the chunk)
+    """
+    lines, seen_request_ids = [], set()
+    line_nbr = 0
+    async for line in iter_ndjson_lines(stream):
+        line_nbr += 1
+        if line.strip():
+            lines.append((line_nbr, line))
+        if len(lines) >= chunk_size:
+            yield (*await run_in_executor(pipeline_executor, parse_ndjson_lines, lines, seen_request_ids), len(lines))
+            lines = []
+    if lines:
+        yield (*await run_in_executor(pipeline_executor, parse_ndjson_lines, lines, seen_request_ids), len(lines))
+
+
+@app.on_event("startup")
+def load_model():
+    # Preload the model and keep it refreshed in the background, so that no request waits for a model download
+    model_refresher.start()
+
 
 # Root URL
 @app.get("/")
-def root_url():
+async def root_url():
     return {
         "status": "SUCCESS",
         "API": "Deployed Markdown Application Test 1"
     }
 
 
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=metrics_registry.render(), media_type=CONTENT_TYPE)
+
+
 @app.get("/healthcheck", status_code=status.HTTP_200_OK)
-def perform_healthcheck():
+async def perform_healthcheck():
     return {
         "healthcheck": "SUCCESS"
     }
@@ -61,17 +236,23 @@ def perform_healthcheck():
 
 # V3 Jyotish API Endpoint
 @app.post("/json/v3_jyotish")
-def get_recommendations(data: Dict[str, ItemClubV3_jyotish]):
-    logger.info("API Request received. Processing of request started")
-    logger.info(f"Number of requests in the batch = {len(data)}")
-    request_manager_handle = RequestsManager(data, PredictionPipeline.process_prediction_pipeline,feature_store)
-    sale_prediction = request_manager_handle.process_requests()
-    logger.info('Predictions Generated')
+async def get_recommendations(data: Dict[str, ItemClubV3_jyotish]):
+    async with serve_batch('v3_jyotish', len(data)):
+        logger.info("API Request received. Processing of request started")
+        logger.info(f"Number of requests in the batch = {len(data)}")
+        request_manager_handle = RequestsManager(data, PredictionPipeline.process_prediction_pipeline,feature_store)
+        club_item_data = await run_in_executor(feature_io_executor, request_manager_handle.get_club_item_data)
+        sale_prediction = await run_in_executor(pipeline_executor, request_manager_handle.process_requests,
+                                                club_item_data)
+        logger.info('Predictions Generated')
+        # Large payloads take a while to serialize, so it is done off the event loop
+        response = await run_in_executor(pipeline_executor, FastJSONResponse, {
+            "status": "SUCCESS",
+            "data": sale_prediction,
+            "misc": dict(model_version=request_manager_handle.model_version)
+        })
 
-    return {
-        "status": "SUCCESS",
-        "data": sale_prediction
-    }
+    return response
 # {
 #   "additionalProp3": {
 #     "club_nbr": "6279",
@@ -86,31 +267,85 @@ def get_recommendations(data: Dict[str, ItemClubV3_jyotish]):
 
 # V3 API Endpoint
 @app.post("/json/v3")
-def get_recommendations(data: Dict[str, ItemClubV3]):
-    starttime = time.perf_counter()
-    #Profiling below piece of code
+async def get_recommendations(data: Dict[str, ItemClubV3]):
+    async with serve_batch('v3', len(data)):
+        starttime = time.perf_counter()
+        #Profiling below piece of code
 
-    logger.info("API Request received. Processing of request started")
-    logger.info(f"Number of requests in the batch = {len(data)}")
-    sale_prediction = process_md_recommendation_pipeline(data,feature_store)
-    logger.info('Predictions Generated')
+        logger.info("API Request received. Processing of request started")
+        logger.info(f"Number of requests in the batch = {len(data)}")
+        club_item_data = await run_in_executor(feature_io_executor, fetch_club_item_data, data, feature_store)
+        sale_prediction = await run_in_executor(pipeline_executor, process_md_recommendation_pipeline, data,
+                                                feature_store, club_item_data)
+        logger.info('Predictions Generated')
 
-    #Profiling ends
-    duration = timedelta(seconds=time.perf_counter()-starttime)
-    logger.info(f"Time taken to run Markdown inclub optimization API: {duration} seconds!")
+        #Profiling ends
+        duration = timedelta(seconds=time.perf_counter()-starttime)
+        logger.info(f"Time taken to run Markdown inclub optimization API: {duration} seconds!")
+        # The pipeline output is already JSON native, it is serialized once and off the event loop
+        response = await run_in_executor(pipeline_executor, FastJSONResponse, {
+            "status": "SUCCESS",
+            "data": sale_prediction
+        })
+
+    count_no_reco_reason_codes('v3', sale_prediction)
+    return response
+
+# Streaming variant of the V3 API Endpoint. Input and output are newline delimited JSON with one request per line,
+# requests are run through the pipeline in chunks and results of a chunk are sent as soon as it is done
+@app.post("/ndjson/v3")
+async def stream_recommendations(request: Request):
+    # The concurrency limit is taken before the response is built, so that a full queue is answered with a 503 rather
+    # than cutting off a 200 stream. The body is read chunk by chunk as the response is streamed, and the limit is
+    # released by the background task, which BodyStreamingResponse always runs.
+    batch_stack = AsyncExitStack()
+    await batch_stack.enter_async_context(serve_batch('v3_stream'))
+
+    async def generate_recommendations():
+        num_lines = 0
+        logger.info("Streaming API Request received. Processing of request started")
+        chunk_nbr = 0
+        chunks = iter_ndjson_chunks(request.stream(), Settings.api_stream_chunk_size)
+        async for chunk, errors, chunk_lines in chunks:
+            chunk_nbr += 1
+            num_lines += chunk_lines
+            for error in errors:
+                yield dump_json(error) + b'\n'
+            if not chunk:
+                continue
+            try:
+                club_item_data = await run_in_executor(feature_io_executor, fetch_club_item_data, chunk, feature_store)
+                sale_prediction = await run_in_executor(pipeline_executor, process_md_recommendation_pipeline, chunk,
+                                                        feature_store, club_item_data)
+            except Exception as e:
+                # A failing chunk doesn't stop the stream, its requests are reported as failed
+                logger.error(f"Chunk {chunk_nbr} of {len(chunk)} requests failed", exc_info=True)
+                yield b''.join(dump_json(dict(request_id=request_id, status="FAILED", error=str(e))) + b'\n'
+                               for request_id in chunk)
+                continue
+            count_no_reco_reason_codes('v3_stream', sale_prediction)
+            logger.info(f"Chunk {chunk_nbr} of {len(chunk)} requests processed")
+            yield b''.join(dump_json(dict(request_id=request_id, **output)) + b'\n'
+                           for request_id, output in sale_prediction.items())
+        observe_batch('v3_stream', num_lines)
+        logger.info('Predictions Generated')
+
+    try:
+        return BodyStreamingResponse(generate_recommendations(), media_type='application/x-ndjson',
+                                     background=BackgroundTask(batch_stack.aclose))
+    except Exception:
+        await batch_stack.aclose()
+        raise
 
-    return {
-        "status": "SUCCESS",
-        "data": sale_prediction
-    }
 
 @app.post("/json/dotcom_prediction")
-def get_recommendations(data: Dict[str, ItemClub_dotcom_prediction]):
-    logger.info("API Request received. Processing of request started")
-    logger.info(f"Number of requests in the batch = {len(data)}")
-    request_manager_handle = RequestsManager_dotcom_prediction(data, PredictionPipeline_dotcom_prediction.process_prediction_pipeline,feature_store)
-    sale_prediction = request_manager_handle.process_requests()
-    logger.info('Predictions Generated')
+async def get_recommendations(data: Dict[str, ItemClub_dotcom_prediction]):
+    async with serve_batch('dotcom_prediction', len(data)):
+        logger.info("API Request received. Processing of request started")
+        logger.info(f"Number of requests in the batch = {len(data)}")
+        request_manager_handle = RequestsManager_dotcom_prediction(data, PredictionPipeline_dotcom_prediction.process_prediction_pipeline,feature_store)
+        sale_prediction = await run_in_executor(pipeline_executor, request_manager_handle.process_requests)
+        logger.info('Predictions Generated')
 
     return {
         "status": "SUCCESS",
@@ -120,12 +355,16 @@ def get_recommendations(data: Dict[str, ItemClub_dotcom_prediction]):
 
 # V3 API Endpoint
 @app.post("/json/dotcom_optimization")
-def get_recommendations(data: Dict[str, ItemClub_dotcom_optimization]):
-    logger.info("API Request received. Processing of request started")
-    logger.info(f"Number of requests in the batch = {len(data)}")
-    sale_prediction = process_md_recommendation_pipeline_dotcom_optimization(data,feature_store)
-    logger.info('Predictions Generated')
+async def get_recommendations(data: Dict[str, ItemClub_dotcom_optimization]):
+    async with serve_batch('dotcom_optimization', len(data)):
+        logger.info("API Request received. Processing of request started")
+        logger.info(f"Number of requests in the batch = {len(data)}")
+        sale_prediction = await run_in_executor(pipeline_executor,
+                                                process_md_recommendation_pipeline_dotcom_optimization, data,
+                                                feature_store)
+        logger.info('Predictions Generated')
 
+    count_no_reco_reason_codes('dotcom_optimization', sale_prediction)
     return {
         "status": "SUCCESS",
         "data": sale_prediction
@@ -0,0 +1,66 @@
+"""
+Description - As-of-date calendar of a V3 request batch
+"""
+
+import datetime
+import functools
+
+from src.config import Settings
+
+DATE_FORMAT = "%Y-%m-%d"
+
+
+@functools.lru_cache(maxsize=8)
+def get_week_calendar(day: datetime.date, num_weeks: int) -> tuple:
+    """
+    (start_date, end_date) strings of the first num_weeks weeks starting on the given day. Cached, so that the strings
+    are built once a day and shared by all the batches
+    """
+    return tuple(((day + datetime.timedelta(days=week_index * 7)).strftime(DATE_FORMAT),
+                  (day + datetime.timedelta(days=week_index * 7 + 6)).strftime(DATE_FORMAT))
+                 for week_index in range(num_weeks))
+
+
+class CalendarContext():
+    """
+    Dates a batch of requests is processed against. It is created once when the batch comes in and handed to every
+    stage of the pipeline, so that all of them use the same today, even when the batch crosses midnight.
+
+    Holds today, the boundaries of the Settings.forcast_duration weeks starting today (as strings and as ordinals) and
+    the ISO week and month of today. Date strings are parsed through get_date_ordinal, which parses every distinct
+    string of the batch only once.
+    """
+
+    def __init__(self, today: datetime.date = None):
+        self.today = today or datetime.date.today()
+        self.today_ordinal = self.today.toordinal()
+        self.today_str = self.today.strftime(DATE_FORMAT)
+        self.iso_week = self.today.isocalendar()[1]
+        self.month = self.today.month
+        self.week_boundaries = get_week_calendar(self.today, len(Settings.forcast_duration))
+        self.week_start_dates = [start_date for start_date, _ in self.week_boundaries]
+        self.week_end_dates = [end_date for _, end_date in self.week_boundaries]
+        self.week_start_ordinals = [self.today_ordinal + week_index * 7 for week_index in
+                                    range(len(self.week_boundaries))]
+        self.week_end_ordinals = [start_ordinal + 6 for start_ordinal in self.week_start_ordinals]
+        self._date_ordinals = {self.today_str: self.today_ordinal}
+
+    def get_date_ordinal(self, date: str) -> int:
+        """
+        Ordinal of a "%Y-%m-%d" date string. Raises the same errors as strptime for values which can't be parsed
+        """
+        ordinal = self._date_ordinals.get(date)
+        if ordinal is None:
+            ordinal = self._date_ordinals[date] = datetime.datetime.strptime(date, DATE_FORMAT).toordinal()
+        return ordinal
+
+    def get_date(self, date: str) -> datetime.date:
+        return datetime.date.fromordinal(self.get_date_ordinal(date))
+
+    def get_week_boundaries(self, num_weeks: int) -> tuple:
+        """
+        (start_date, end_date) strings of the first num_weeks weeks starting today
+        """
+        if num_weeks <= len(self.week_boundaries):
+            return self.week_boundaries[:num_weeks]
+        return get_week_calendar(self.today, num_weeks)
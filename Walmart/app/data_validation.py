@@ -9,28 +9,33 @@ __maintainer__ = '{Suyash}'
 __email__ = ['Suyash.Garg@walmart.com']
 __status__ = 'Development'
 
-import datetime
-import json
-import logging
+import math
 import traceback
-import time
-from datetime import timedelta
 
+import numpy as np
 import pandas as pd
 from typing import Dict
-from numba import jit
 
 from src.config import Settings
 from src.utils import is_equal
+from src.v3.calendar_context import CalendarContext
 from src.v3.data_model import ItemClub
+from src.log_config import get_logger
 
 # Set Logging Configurations
-logger = logging.getLogger(__name__)
-handler = logging.StreamHandler()
-logger.setLevel(logging.INFO)
-format_ = logging.Formatter('%(asctime)s - [%(name)s] - [%(levelname)s] - %(message)s')
-handler.setFormatter(format_)
-logger.addHandler(handler)
+logger = get_logger(__name__)
+
+# Remarks of the output validation rules
+OUTPUT_MISMATCH_REMARK = 'We have encountered a problem with the output values in this plan ID. Please create a support incident through the Help menu for this issue.'
+MARKDOWN_RECOMMENDATION_REMARK = "We've encountered a problem providing a valid recommended price or markdown start date. Please create a support incident through the Help menu for this issue"
+EXPECTED_SALE_UNITS_REMARK = "Recommendation exceeds current inventory. Please create support incident through the Help menu for this issue"
+DATA_QUALITY_REMARK = "We've encountered a problem with data quality checks. Please create a support incident through the Help menu for this issue"
+MODEL_FEATURES_REMARK = "We've encountered a problem with the output features in this plan ID. Please create a support incident through the Help menu for this issue"
+NO_RECO_REASON_CODE_REMARK = "We've encountered a problem with the output error reason in this plan ID . Please create a support incident through the Help menu for this issue"
+PRICE_ENDING_REMARK = "We've encountered a problem with price point ending validation. Please create a support incident through the Help menu for this issue"
+
+# Types which format_output_as_dict leaves as they are
+JSON_SCALAR_TYPES = (str, int, bool, type(None))
 
 
 def validate_club_nbr(data: pd.core.series.Series) -> str:
@@ -81,17 +86,15 @@ def validate_liquidation_price(data: pd.core.series.Series) -> str:
         return "We've encountered a problem with liquidation price data. Please create a support incident through the Help menu for this issue."
 
 
-def validate_outofstock_date(data: pd.core.series.Series) -> str:
+def validate_outofstock_date(data: pd.core.series.Series, calendar: CalendarContext) -> str:
     """
     Description - Function Validates the OOS Date
     """
     try:
-        # TODO: Pick the date format from config file
-        oos_date = datetime.datetime.strptime(data['oos_date'], "%Y-%m-%d").date()
+        oos_date = calendar.get_date_ordinal(data['oos_date'])
     except ValueError:
         return "We've encountered a problem with the Out-of-stock date format. Please create a support incident through the Help menu for this issue."
-    today = datetime.date.today()
-    date_difference = (oos_date - today).days
+    date_difference = oos_date - calendar.today_ordinal
 
     # Check if Out of Stock Date is Within 8 Weeks from Today
     if date_difference >= Settings.max_forecast_weeks * 7:
@@ -101,18 +104,17 @@ def validate_outofstock_date(data: pd.core.series.Series) -> str:
     return ''
 
 
-def validate_mdstart_date(data: pd.core.series.Series) -> str:
+def validate_mdstart_date(data: pd.core.series.Series, calendar: CalendarContext) -> str:
     """
     Description - Function Validates the Markdown Start Date
     """
 
     if not pd.isna(data['md_start_date']):
         try:
-            md_start_date = datetime.datetime.strptime(data['md_start_date'], "%Y-%m-%d").date()
+            md_start_date = calendar.get_date_ordinal(data['md_start_date'])
         except ValueError:
             return "We've encountered a problem with the Markdown start date format. Please create a support incident through the Help menu for this issue.t"
-        today = datetime.date.today()
-        date_difference = (md_start_date - today).days
+        date_difference = md_start_date - calendar.today_ordinal
         # Check if Start Date is not a Historic Date
         if (Settings.enable_historic_data_requests is False) and (date_difference < 0):
             return 'Markdown Start Date is in Past'
@@ -131,16 +133,17 @@ def validate_sell_through_threshold(data: pd.core.series.Series) -> str:
     return ''
 
 
-def validate_cross_features(data: pd.core.series.Series) -> str:
+def validate_cross_features(data: pd.core.series.Series, calendar: CalendarContext) -> str:
     """
     Do validations which require interaction of multiple features
     :param data:
+    :param calendar:
     :return:
     """
     if not pd.isna(data['md_start_date']):
-        md_start_date = datetime.datetime.strptime(data['md_start_date'], "%Y-%m-%d").date()
-        oos_date = datetime.datetime.strptime(data['oos_date'], "%Y-%m-%d").date()
-        if (oos_date - md_start_date).days < 6:
+        md_start_date = calendar.get_date_ordinal(data['md_start_date'])
+        oos_date = calendar.get_date_ordinal(data['oos_date'])
+        if oos_date - md_start_date < 6:
             return "Out-of-stock date must be at least 6 days after markdown start date."
 
     if data['liquidation_price'] > data['current_retail_price']:
@@ -149,40 +152,119 @@ def validate_cross_features(data: pd.core.series.Series) -> str:
     return ''
 
 
-@jit(parallel=True)
-def validate_input(item_club_data: pd.core.series.Series) -> pd.core.series.Series:
+def validate_input(item_club_data: pd.core.series.Series, calendar: CalendarContext = None) -> pd.core.series.Series:
     """
     Validates each of the input field passed in the input of the V3 API and sets the value of no_reco_reason_code and
-    remark accordingly
+    remark accordingly. Row level reference implementation of validate_input_batch, which the pipeline runs; the tests
+    check that both give the same output.
     """
-    starttime = time.perf_counter()
-    #Profiling below piece of code
-
+    calendar = calendar or CalendarContext()
     failure_remarks = []
 
     # Pipeline of all the Validation Functions
 
     failure_remarks.append(validate_club_nbr(item_club_data))
     failure_remarks.append(validate_customer_item_nbr(item_club_data))
-    failure_remarks.append(validate_outofstock_date(item_club_data))
-    failure_remarks.append(validate_mdstart_date(item_club_data))
+    failure_remarks.append(validate_outofstock_date(item_club_data, calendar))
+    failure_remarks.append(validate_mdstart_date(item_club_data, calendar))
     failure_remarks.append(validate_sell_through_threshold(item_club_data))
     failure_remarks.append(validate_current_inventory(item_club_data))
     failure_remarks.append(validate_current_price(item_club_data))
     failure_remarks.append(validate_liquidation_price(item_club_data))
-    failure_remarks.append(validate_cross_features(item_club_data))
+    failure_remarks.append(validate_cross_features(item_club_data, calendar))
 
     # Check if there is validation failure remark from any of the Validation Functions
     failure_remarks = [remark for remark in failure_remarks if remark]
     final_remark = '; '.join(failure_remarks)
     item_club_data['no_reco_reason_code'] = 'invalid_input' if final_remark else 'recommendation_successful'
     item_club_data['remark'] = final_remark
+    return item_club_data
 
-    #Profiling ends
-    duration = timedelta(seconds=time.perf_counter()-starttime)
-    logger.info(f"Time taken in validate_input(): {duration} seconds!")
 
-    return item_club_data
+def parse_date_ordinals(dates: pd.core.series.Series, calendar: CalendarContext) -> np.ndarray:
+    """
+    Parses a column of "%Y-%m-%d" date strings into date ordinals. Every distinct value is parsed only once, with the
+    same strptime rule as the row level validators. Missing values and values which can't be parsed are set to NaN.
+    """
+    ordinals = {}
+    for value in pd.unique(dates.dropna()):
+        try:
+            ordinals[value] = calendar.get_date_ordinal(value)
+        except ValueError:
+            ordinals[value] = np.nan
+    return dates.map(ordinals).to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def join_remarks(remarks: list) -> np.ndarray:
+    """
+    Column wise equivalent of '; '.join() on the non-empty remarks of each row
+    """
+    final_remark = np.full(len(remarks[0]), '', dtype=object)
+    for remark in remarks:
+        remark = remark.astype(object)
+        separator = np.where((final_remark != '') & (remark != ''), '; ', '').astype(object)
+        final_remark = final_remark + separator + remark
+    return final_remark
+
+
+def validate_input_batch(data: pd.core.frame.DataFrame, calendar: CalendarContext = None) -> pd.core.frame.DataFrame:
+    """
+    Validates each of the input field passed in the input of the V3 API for all the rows at once and sets the value of
+    no_reco_reason_code and remark accordingly. Every rule of validate_input is applied as a column operation, so the
+    output is the same as applying validate_input on each row. The only difference is an md_start_date or oos_date
+    which can't be parsed along with an md_start_date, where validate_cross_features raises for the whole batch while
+    here the row is only flagged with the date format remark.
+    """
+    calendar = calendar or CalendarContext()
+    today = calendar.today_ordinal
+    max_forecast_days = Settings.max_forecast_weeks * 7
+    check_past = Settings.enable_historic_data_requests is False
+
+    oos_date = parse_date_ordinals(data['oos_date'], calendar)
+    md_start_date = parse_date_ordinals(data['md_start_date'], calendar)
+    md_start_date_given = data['md_start_date'].notna().to_numpy()
+    oos_date_difference = oos_date - today
+    md_start_date_difference = md_start_date - today
+    sell_through_threshold = data['sell_through_threshold'].to_numpy(dtype=np.float64, na_value=np.nan)
+    current_inventory = data['current_inventory'].to_numpy(dtype=np.float64, na_value=np.nan)
+    current_retail_price = data['current_retail_price'].to_numpy(dtype=np.float64, na_value=np.nan)
+    liquidation_price = data['liquidation_price'].to_numpy(dtype=np.float64, na_value=np.nan)
+
+    # Pipeline of all the Validation rules, in the same order as in validate_input
+    remarks = [
+        np.where([isinstance(value, str) for value in data['club_nbr']], '',
+                 "We've encountered a problem with club number format. Check for valid Input eg: '8299'"),
+        np.where([isinstance(value, str) for value in data['customer_item_nbr']], '',
+                 "We've encountered a problem with item number format. Check for valid input eg: '980254364'"),
+        np.select([np.isnan(oos_date),
+                   oos_date_difference >= max_forecast_days,
+                   check_past & (oos_date_difference < 0)],
+                  ["We've encountered a problem with the Out-of-stock date format. Please create a support incident through the Help menu for this issue.",
+                   f'Out-of-stock date cannot be more than {Settings.max_forecast_weeks} Weeks from today date',
+                   'OOS Date is in Past'], ''),
+        np.select([md_start_date_given & np.isnan(md_start_date),
+                   md_start_date_given & check_past & (md_start_date_difference < 0),
+                   md_start_date_given & (md_start_date_difference >= max_forecast_days)],
+                  ["We've encountered a problem with the Markdown start date format. Please create a support incident through the Help menu for this issue.t",
+                   'Markdown Start Date is in Past',
+                   f'Markdown start date cannot be more than {Settings.max_forecast_weeks} Weeks from today date'], ''),
+        np.where(~np.isnan(sell_through_threshold) & ~((sell_through_threshold >= 0) & (sell_through_threshold <= 1)),
+                 "DS model couldn't compute a valid recommendation. Please create a support incident through the Help menu for this issue.", ''),
+        np.where(current_inventory > 0, '',
+                 "Current on hands are less than or equal to zero. On hands must be positive to recommend a price."),
+        np.where(current_retail_price > 0, '',
+                 "We've encountered a problem with retail price data. Please create a support incident through the Help menu for this issue"),
+        np.where(liquidation_price >= 0, '',
+                 "We've encountered a problem with liquidation price data. Please create a support incident through the Help menu for this issue."),
+        np.select([md_start_date_given & ((oos_date - md_start_date) < 6),
+                   liquidation_price > current_retail_price],
+                  ["Out-of-stock date must be at least 6 days after markdown start date.",
+                   'Liquidation price is greater than current retail price.'], ''),
+    ]
+
+    final_remark = join_remarks(remarks)
+    return data.assign(no_reco_reason_code=np.where(final_remark != '', 'invalid_input', 'recommendation_successful'),
+                       remark=final_remark)
 
 def get_dummy_output(input_data: ItemClub, no_reco_reason_code: str, remark: str) -> dict:
     input_dict = input_data.dict()
@@ -208,7 +290,7 @@ def validate_same_request_ids_in_input_and_output(input_data: Dict[str, ItemClub
     output_data = {key: value for key, value in output_data.items() if key in input_data}
     requests_only_in_input = input_data.keys() - output_data.keys()
     for request_id in requests_only_in_input:
-        remark = 'We have encountered a problem with the output values in this plan ID. Please create a support incident through the Help menu for this issue.'
+        remark = OUTPUT_MISMATCH_REMARK
         output_data[request_id] = get_dummy_output(input_data[request_id], 'unexpected_error', remark)
 
     # Ensure that common fields in input and output contain the same value
@@ -220,30 +302,28 @@ def validate_same_request_ids_in_input_and_output(input_data: Dict[str, ItemClub
         # change because of different float number storage approaches
         if not all([is_equal(input_dict[key], output_dict.get(key), 0.001) if isinstance(input_dict[key], float) else
                     input_dict[key] == output_dict.get(key) for key in common_keys]):
-            remark = 'We have encountered a problem with the output values in this plan ID. Please create a support incident through the Help menu for this issue.'
+            remark = OUTPUT_MISMATCH_REMARK
             output_data[request_id] = get_dummy_output(input_obj, 'unexpected_error', remark)
 
     return output_data
 
 
-def validate_markdown_recommendation(output: dict) -> list:
+def validate_markdown_recommendation(output: dict, calendar: CalendarContext) -> list:
     validation_failure_remarks = []
     if isinstance(output['no_reco_reason_code'], str) and output['no_reco_reason_code'] == 'recommendation_successful':
         if isinstance(output['markdown_recommendation'], list) and (len(output['markdown_recommendation']) > 0):
-            oos_date = datetime.datetime.strptime(output['oos_date'], "%Y-%m-%d").date()
+            oos_date = calendar.get_date_ordinal(output['oos_date'])
             for recommendation in output['markdown_recommendation']:
-                today = datetime.date.today()
-                session_date = datetime.datetime.strptime(recommendation['markdown_session_start_date'],
-                                                          "%Y-%m-%d").date()
-                if not (today <= session_date <= oos_date):
-                    validation_failure_remarks.append("We've encountered a problem providing a valid recommended price or markdown start date. Please create a support incident through the Help menu for this issue")
+                session_date = calendar.get_date_ordinal(recommendation['markdown_session_start_date'])
+                if not (calendar.today_ordinal <= session_date <= oos_date):
+                    validation_failure_remarks.append(MARKDOWN_RECOMMENDATION_REMARK)
                 if not (0 < recommendation['recommended_markdown_price'] <= output['current_retail_price']):
-                    validation_failure_remarks.append("We've encountered a problem providing a valid recommended price or markdown start date. Please create a support incident through the Help menu for this issue")
+                    validation_failure_remarks.append(MARKDOWN_RECOMMENDATION_REMARK)
         else:
-            validation_failure_remarks.append("We've encountered a problem providing a valid recommended price or markdown start date. Please create a support incident through the Help menu for this issue")
+            validation_failure_remarks.append(MARKDOWN_RECOMMENDATION_REMARK)
     else:
         if output['markdown_recommendation'] is not None:
-            validation_failure_remarks.append("We've encountered a problem providing a valid recommended price or markdown start date. Please create a support incident through the Help menu for this issue")
+            validation_failure_remarks.append(MARKDOWN_RECOMMENDATION_REMARK)
     return validation_failure_remarks
 
 
@@ -252,38 +332,38 @@ def validate_expected_sale_units(output: dict) -> list:
     if isinstance(output['no_reco_reason_code'], str) and output['no_reco_reason_code'] == 'recommendation_successful':
         expected_sale = output['expected_sale_units']
         if not (isinstance(expected_sale, int) and 0 <= expected_sale <= output['current_inventory']):
-            validation_failure_remarks.append("Recommendation exceeds current inventory. Please create support incident through the Help menu for this issue")
+            validation_failure_remarks.append(EXPECTED_SALE_UNITS_REMARK)
     else:
         if output['expected_sale_units'] is not None:
-            validation_failure_remarks.append("Recommendation exceeds current inventory. Please create support incident through the Help menu for this issue")
+            validation_failure_remarks.append(EXPECTED_SALE_UNITS_REMARK)
     return validation_failure_remarks
 
 
-def validate_week_level_expected_sale_units(output: dict) -> list:
+def validate_week_level_expected_sale_units(output: dict, calendar: CalendarContext) -> list:
     validation_failure_remarks = []
     if isinstance(output['no_reco_reason_code'], str) and output['no_reco_reason_code'] == 'recommendation_successful':
         weekly_sale = [data['expected_sale_units'] for data in output['week_level_expected_sale_units']]
         if not all([(sale >= 0) for sale in weekly_sale if sale!= None]):
-            validation_failure_remarks.append("We've encountered a problem with data quality checks. Please create a support incident through the Help menu for this issue")
+            validation_failure_remarks.append(DATA_QUALITY_REMARK)
         elif round(sum(filter(None, weekly_sale))) > output['current_inventory']:
-            validation_failure_remarks.append("We've encountered a problem with data quality checks. Please create a support incident through the Help menu for this issue")
+            validation_failure_remarks.append(DATA_QUALITY_REMARK)
         # elif round(sum(weekly_sale)) != output['expected_sale_units']:
         #     validation_failure_remarks.append("week_level_expected_sale_units sum is not equal to expected_sale_units")
         try:
-            today = datetime.date.today()
-            if any([(datetime.datetime.strptime(data['start_date'], "%Y-%m-%d").date() - today).days != week_index * 7
+            today = calendar.today_ordinal
+            if any([calendar.get_date_ordinal(data['start_date']) - today != week_index * 7
                     for week_index, data in enumerate(output['week_level_expected_sale_units'])]):
-                validation_failure_remarks.append("We've encountered a problem with data quality checks. Please create a support incident through the Help menu for this issue")
-            if any([(datetime.datetime.strptime(data['end_date'], "%Y-%m-%d").date() - today).days != week_index * 7 + 6
+                validation_failure_remarks.append(DATA_QUALITY_REMARK)
+            if any([calendar.get_date_ordinal(data['end_date']) - today != week_index * 7 + 6
                     for week_index, data in enumerate(output['week_level_expected_sale_units'][:-1])]):
-                validation_failure_remarks.append("We've encountered a problem with data quality checks. Please create a support incident through the Help menu for this issue")
+                validation_failure_remarks.append(DATA_QUALITY_REMARK)
             if output['week_level_expected_sale_units'][-1]['end_date'] != output['oos_date']:
-                validation_failure_remarks.append("We've encountered a problem with data quality checks. Please create a support incident through the Help menu for this issue")
+                validation_failure_remarks.append(DATA_QUALITY_REMARK)
         except Exception as e:
-            validation_failure_remarks.append("We've encountered a problem with data quality checks. Please create a support incident through the Help menu for this issue")
+            validation_failure_remarks.append(DATA_QUALITY_REMARK)
     else:
         if output['week_level_expected_sale_units'] is not None:
-            validation_failure_remarks.append("We've encountered a problem with data quality checks. Please create a support incident through the Help menu for this issue")
+            validation_failure_remarks.append(DATA_QUALITY_REMARK)
     return validation_failure_remarks
 
 
@@ -293,10 +373,10 @@ def validate_expected_revenue(output: dict) -> list:
         max_possible_revenue = output['current_retail_price'] * output['current_inventory']
         expected_revenue = output['expected_revenue']
         if not (isinstance(expected_revenue, (int, float)) and (0 <= expected_revenue <= max_possible_revenue + 0.01)):
-            validation_failure_remarks.append("We've encountered a problem with data quality checks. Please create a support incident through the Help menu for this issue")
+            validation_failure_remarks.append(DATA_QUALITY_REMARK)
     else:
         if output['expected_revenue'] is not None:
-            validation_failure_remarks.append("We've encountered a problem with data quality checks. Please create a support incident through the Help menu for this issue")
+            validation_failure_remarks.append(DATA_QUALITY_REMARK)
     return validation_failure_remarks
 
 
@@ -304,43 +384,51 @@ def validate_model_features(output: dict) -> list:
     validation_failure_remarks = []
     if isinstance(output['no_reco_reason_code'], str) and output['no_reco_reason_code'] == 'recommendation_successful':
         if not (isinstance(output['model_features'], dict) and (len(output['model_features']) > 0)):
-            validation_failure_remarks.append("We've encountered a problem with the output features in this plan ID. Please create a support incident through the Help menu for this issue")
+            validation_failure_remarks.append(MODEL_FEATURES_REMARK)
     return validation_failure_remarks
 
 def validate_no_reco_reason_code(output: dict) -> list:
     validation_failure_remarks = []
     if output['no_reco_reason_code'] not in Settings.valid_no_reco_reason_code:
-        validation_failure_remarks.append("We've encountered a problem with the output error reason in this plan ID . Please create a support incident through the Help menu for this issue")
+        validation_failure_remarks.append(NO_RECO_REASON_CODE_REMARK)
     return validation_failure_remarks
 
 
 def validate_remark(output: dict) -> list:
     validation_failure_remarks = []
     if not (isinstance(output['remark'], str) or output['remark'] is None):
-        validation_failure_remarks.append("We've encountered a problem with data quality checks. Please create a support incident through the Help menu for this issue")
+        validation_failure_remarks.append(DATA_QUALITY_REMARK)
     return validation_failure_remarks
 
 
-def validate_output_field_values(input_data: Dict[str, ItemClub], output_data: Dict[str, dict]) -> Dict[str, dict]:
+def get_output_field_remarks(output: dict, calendar: CalendarContext) -> list:
+    validation_failure_remarks = []
+    validation_failure_remarks.extend(validate_markdown_recommendation(output, calendar))
+    validation_failure_remarks.extend(validate_expected_sale_units(output))
+    validation_failure_remarks.extend(validate_week_level_expected_sale_units(output, calendar))
+    validation_failure_remarks.extend(validate_expected_revenue(output))
+    validation_failure_remarks.extend(validate_model_features(output))
+    validation_failure_remarks.extend(validate_no_reco_reason_code(output))
+    validation_failure_remarks.extend(validate_remark(output))
+    return validation_failure_remarks
+
+
+def validate_output_field_values(input_data: Dict[str, ItemClub], output_data: Dict[str, dict],
+                                 calendar: CalendarContext = None) -> Dict[str, dict]:
     """
     Validate output fields (apart from the ones which are directly inherited from the input). If validation fails,
     replace output for that request with dummy output containing the unexpected_error message
 
     :param input_data:
     :param output_data:
+    :param calendar:
     :return:
     """
+    calendar = calendar or CalendarContext()
     erroneous_output = {}
     for request_id, output in output_data.items():
         try:
-            validation_failure_remarks = []
-            validation_failure_remarks.extend(validate_markdown_recommendation(output))
-            validation_failure_remarks.extend(validate_expected_sale_units(output))
-            validation_failure_remarks.extend(validate_week_level_expected_sale_units(output))
-            validation_failure_remarks.extend(validate_expected_revenue(output))
-            validation_failure_remarks.extend(validate_model_features(output))
-            validation_failure_remarks.extend(validate_no_reco_reason_code(output))
-            validation_failure_remarks.extend(validate_remark(output))
+            validation_failure_remarks = get_output_field_remarks(output, calendar)
             if validation_failure_remarks:
                 remark = '; '.join(validation_failure_remarks)
                 erroneous_output[request_id] = get_dummy_output(input_data[request_id], 'unexpected_error', remark)
@@ -375,7 +463,7 @@ def validate_ninety_nine_cent_policy(output: dict) -> list:
     for recommendation in output['markdown_recommendation']:
         price_reco = recommendation['recommended_markdown_price']
         if is_equal(int(price_reco) + 0.99, price_reco):
-            return ["We've encountered a problem with price point ending validation. Please create a support incident through the Help menu for this issue"]
+            return [PRICE_ENDING_REMARK]
     return []
 
 
@@ -393,10 +481,19 @@ def validate_critical_price_point_policy(output: dict) -> list:
                 price_reco = recommendation['recommended_markdown_price']
                 price_reco_fraction = price_reco - int(price_reco)
                 if not any([is_equal(price_reco_fraction, price_fraction) for price_fraction in Settings.dict_critical_pp_list[i]  ]):
-                    return ["We've encountered a problem with price point ending validation. Please create a support incident through the Help menu for this issue"]
+                    return [PRICE_ENDING_REMARK]
     return []
 
 
+def get_business_policy_remarks(output: dict) -> list:
+    validation_failure_remarks = []
+    validation_failure_remarks.extend(validate_max_price_policy(output))
+    validation_failure_remarks.extend(validate_min_price_policy(output))
+    validation_failure_remarks.extend(validate_ninety_nine_cent_policy(output))
+    validation_failure_remarks.extend(validate_critical_price_point_policy(output))
+    return validation_failure_remarks
+
+
 def validate_business_policy(input_data: Dict[str, ItemClub], output_data: Dict[str, dict]) -> Dict[str, dict]:
     """
     Validate all the business policies on the output we have got. If validation fails, replace output for that request
@@ -409,11 +506,7 @@ def validate_business_policy(input_data: Dict[str, ItemClub], output_data: Dict[
     erroneous_output = {}
     for request_id, output in output_data.items():
         if output['no_reco_reason_code'] == 'recommendation_successful':
-            validation_failure_remarks = []
-            validation_failure_remarks.extend(validate_max_price_policy(output))
-            validation_failure_remarks.extend(validate_min_price_policy(output))
-            validation_failure_remarks.extend(validate_ninety_nine_cent_policy(output))
-            validation_failure_remarks.extend(validate_critical_price_point_policy(output))
+            validation_failure_remarks = get_business_policy_remarks(output)
             if validation_failure_remarks:
                 remark = '; '.join(validation_failure_remarks)
                 erroneous_output[request_id] = get_dummy_output(input_data[request_id], 'unexpected_error', remark)
@@ -421,7 +514,8 @@ def validate_business_policy(input_data: Dict[str, ItemClub], output_data: Dict[
     return output_data
 
 
-def validate_output(input_data: Dict[str, ItemClub], output_data: Dict[str, dict]) -> Dict[str, dict]:
+def validate_output(input_data: Dict[str, ItemClub], output_data: Dict[str, dict],
+                    calendar: CalendarContext = None) -> Dict[str, dict]:
     """"Following Points are validated:
         1. Number of club_items in input and output are same
         2. recommended_markdown_price should be float if no_reco_reason_code is 'recommendation_successful'
@@ -434,43 +528,389 @@ def validate_output(input_data: Dict[str, ItemClub], output_data: Dict[str, dict
                 cents.
 
         We set no_reco_reason_code to unexpected_error if validation fails
+
+        Row level reference implementation of validate_output_batch, which the pipeline runs; the tests check that both
+        give the same output.
         """
-    logger.info("Validation the output generated")
+    logger.debug("Validation the output generated")
     output_data = validate_same_request_ids_in_input_and_output(input_data, output_data)
-    output_data = validate_output_field_values(input_data, output_data)
+    output_data = validate_output_field_values(input_data, output_data, calendar)
     output_data = validate_business_policy(input_data, output_data)
     return output_data
 
 
-def format_output_as_dict(data: pd.core.frame.DataFrame) -> dict:
+def is_number(value) -> bool:
+    return type(value) in (int, float)
+
+
+def values_match(input_value, output_value) -> bool:
+    if isinstance(input_value, float):
+        # Finite floats which are exactly equal are equal within any tolerance, is_equal is only called for the rest
+        return (input_value == output_value and math.isfinite(input_value)) or is_equal(input_value, output_value,
+                                                                                        0.001)
+    return input_value == output_value
+
+
+def get_output_mismatch_mask(inputs: list, outputs: list) -> np.ndarray:
+    """
+    Rows for which a field common to the input and the output doesn't have the same value, same rule as
+    validate_same_request_ids_in_input_and_output. Fields are read from the ItemClub objects instead of calling dict()
+    """
+    mismatch = np.zeros(len(inputs), dtype=bool)
+    for key in set(ItemClub.__fields__).intersection(Settings.output_cols):
+        mismatch |= np.array([not values_match(getattr(input_obj, key), output.get(key))
+                              for input_obj, output in zip(inputs, outputs)], dtype=bool)
+    return mismatch
+
+
+class OutputColumns():
+    """
+    Fields of a batch of outputs which are needed by the output validation rules, as arrays. Markdown recommendations
+    and weeks of all the rows are flattened into arrays along with the row they belong to.
+
+    Rows which are not well formed (missing keys, unexpected types, dates which can't be parsed) are only flagged in
+    fallback, the validation rules are applied to them one output at a time so that their remarks stay the same.
+    """
+
+    def __init__(self, outputs: list, calendar: CalendarContext):
+        num_rows = len(outputs)
+        self.fallback = np.zeros(num_rows, dtype=bool)
+        self.successful = np.zeros(num_rows, dtype=bool)
+        self.current_retail_price = np.full(num_rows, np.nan)
+        self.current_inventory = np.full(num_rows, np.nan)
+        self.oos_date = np.zeros(num_rows, dtype=np.int64)
+        self.expected_sale_units = np.full(num_rows, np.nan)
+        self.expected_revenue = np.full(num_rows, np.nan)
+        # Remarks of the rules which are fully decided while reading the rows
+        self.markdown_recommendation_failures = np.zeros(num_rows, dtype=np.int64)
+        self.expected_sale_units_failed = np.zeros(num_rows, dtype=bool)
+        self.week_level_failures = np.zeros(num_rows, dtype=np.int64)
+        self.expected_revenue_failed = np.zeros(num_rows, dtype=bool)
+        self.model_features_failed = np.zeros(num_rows, dtype=bool)
+        self.no_reco_reason_code_failed = np.zeros(num_rows, dtype=bool)
+        self.remark_failed = np.zeros(num_rows, dtype=bool)
+        recommendation_rows, recommendation_dates, recommendation_prices = [], [], []
+        week_rows, week_indexes, week_start_dates = [], [], []
+        end_week_rows, end_week_indexes, week_end_dates = [], [], []
+
+        for row, output in enumerate(outputs):
+            try:
+                no_reco_reason_code = output['no_reco_reason_code']
+                self.no_reco_reason_code_failed[row] = no_reco_reason_code not in Settings.valid_no_reco_reason_code
+                self.remark_failed[row] = not (isinstance(output['remark'], str) or output['remark'] is None)
+                if not (isinstance(no_reco_reason_code, str) and no_reco_reason_code == 'recommendation_successful'):
+                    self.markdown_recommendation_failures[row] = output['markdown_recommendation'] is not None
+                    self.expected_sale_units_failed[row] = output['expected_sale_units'] is not None
+                    self.week_level_failures[row] = output['week_level_expected_sale_units'] is not None
+                    self.expected_revenue_failed[row] = output['expected_revenue'] is not None
+                    continue
+
+                current_retail_price = output['current_retail_price']
+                current_inventory = output['current_inventory']
+                if not (is_number(current_retail_price) and is_number(current_inventory)):
+                    raise TypeError("current_retail_price and current_inventory must be numbers")
+                markdown_recommendation = output['markdown_recommendation']
+                if isinstance(markdown_recommendation, list) and len(markdown_recommendation) > 0:
+                    oos_date = calendar.get_date_ordinal(output['oos_date'])
+                    dates = [calendar.get_date_ordinal(recommendation['markdown_session_start_date'])
+                             for recommendation in markdown_recommendation]
+                    prices = [recommendation['recommended_markdown_price']
+                              for recommendation in markdown_recommendation]
+                    if not all(is_number(price) for price in prices):
+                        raise TypeError("recommended_markdown_price must be a number")
+                else:
+                    oos_date, dates, prices = 0, [], []
+                    self.markdown_recommendation_failures[row] = 1
+
+                week_level_expected_sale_units = output['week_level_expected_sale_units']
+                weekly_sale = [data['expected_sale_units'] for data in week_level_expected_sale_units]
+                if not all(sale is None or is_number(sale) for sale in weekly_sale):
+                    raise TypeError("Weekly expected_sale_units must be numbers")
+                week_failures = 0
+                if not all([(sale >= 0) for sale in weekly_sale if sale != None]):
+                    week_failures += 1
+                elif round(sum(filter(None, weekly_sale))) > current_inventory:
+                    week_failures += 1
+                if week_level_expected_sale_units:
+                    start_dates = [calendar.get_date_ordinal(data['start_date'])
+                                   for data in week_level_expected_sale_units]
+                    end_dates = [calendar.get_date_ordinal(data['end_date'])
+                                 for data in week_level_expected_sale_units[:-1]]
+                    week_failures += week_level_expected_sale_units[-1]['end_date'] != output['oos_date']
+                else:
+                    # No last week to compare with the oos_date
+                    start_dates, end_dates = [], []
+                    week_failures += 1
+                model_features = output['model_features']
+                expected_sale_units = output['expected_sale_units']
+                expected_revenue = output['expected_revenue']
+            except Exception:
+                self.fallback[row] = True
+                continue
+
+            self.successful[row] = True
+            self.current_retail_price[row] = current_retail_price
+            self.current_inventory[row] = current_inventory
+            self.oos_date[row] = oos_date
+            recommendation_rows.extend([row] * len(prices))
+            recommendation_dates.extend(dates)
+            recommendation_prices.extend(prices)
+            self.week_level_failures[row] = week_failures
+            week_rows.extend([row] * len(start_dates))
+            week_indexes.extend(range(len(start_dates)))
+            week_start_dates.extend(start_dates)
+            end_week_rows.extend([row] * len(end_dates))
+            end_week_indexes.extend(range(len(end_dates)))
+            week_end_dates.extend(end_dates)
+            self.model_features_failed[row] = not (isinstance(model_features, dict) and (len(model_features) > 0))
+            if isinstance(expected_sale_units, int):
+                self.expected_sale_units[row] = expected_sale_units
+            if isinstance(expected_revenue, (int, float)):
+                self.expected_revenue[row] = expected_revenue
+
+        self.recommendation_rows = np.array(recommendation_rows, dtype=np.int64)
+        self.recommendation_dates = np.array(recommendation_dates, dtype=np.int64)
+        self.recommendation_prices = np.array(recommendation_prices, dtype=np.float64)
+        self.week_rows = np.array(week_rows, dtype=np.int64)
+        self.week_indexes = np.array(week_indexes, dtype=np.int64)
+        self.week_start_dates = np.array(week_start_dates, dtype=np.int64)
+        self.end_week_rows = np.array(end_week_rows, dtype=np.int64)
+        self.end_week_indexes = np.array(end_week_indexes, dtype=np.int64)
+        self.week_end_dates = np.array(week_end_dates, dtype=np.int64)
+
+    def count_per_row(self, rows: np.ndarray, failed: np.ndarray) -> np.ndarray:
+        return np.bincount(rows[failed], minlength=len(self.successful))
+
+
+def get_output_field_failure_remarks(outputs: list, columns: OutputColumns, calendar: CalendarContext) -> list:
+    """
+    Remark of every row failing the output field rules of get_output_field_remarks, None for the rows which pass
+    """
+    today = calendar.today_ordinal
+    successful = columns.successful
+    rows = columns.recommendation_rows
+    markdown_recommendation_failures = (
+            columns.markdown_recommendation_failures
+            + columns.count_per_row(rows, (columns.recommendation_dates < today)
+                                    | (columns.recommendation_dates > columns.oos_date[rows]))
+            + columns.count_per_row(rows, ~((0 < columns.recommendation_prices)
+                                            & (columns.recommendation_prices <= columns.current_retail_price[rows]))))
+    # NaN stands for a value which is not an int, which fails the rule as well
+    expected_sale_units_failed = columns.expected_sale_units_failed | (
+            successful & ~((0 <= columns.expected_sale_units)
+                           & (columns.expected_sale_units <= columns.current_inventory)))
+    week_level_failures = (
+            columns.week_level_failures
+            + (columns.count_per_row(columns.week_rows,
+                                     columns.week_start_dates - today != columns.week_indexes * 7) > 0)
+            + (columns.count_per_row(columns.end_week_rows,
+                                     columns.week_end_dates - today != columns.end_week_indexes * 7 + 6) > 0))
+    max_possible_revenue = columns.current_retail_price * columns.current_inventory
+    expected_revenue_failed = columns.expected_revenue_failed | (
+            successful & ~((0 <= columns.expected_revenue) & (columns.expected_revenue <= max_possible_revenue + 0.01)))
+    failed = ((markdown_recommendation_failures > 0) | expected_sale_units_failed | (week_level_failures > 0)
+              | expected_revenue_failed | columns.model_features_failed | columns.no_reco_reason_code_failed
+              | columns.remark_failed)
+
+    failure_remarks = [None] * len(outputs)
+    for row in np.flatnonzero(failed & ~columns.fallback):
+        remarks = ([MARKDOWN_RECOMMENDATION_REMARK] * int(markdown_recommendation_failures[row])
+                   + [EXPECTED_SALE_UNITS_REMARK] * int(expected_sale_units_failed[row])
+                   + [DATA_QUALITY_REMARK] * int(week_level_failures[row])
+                   + [DATA_QUALITY_REMARK] * int(expected_revenue_failed[row])
+                   + [MODEL_FEATURES_REMARK] * int(columns.model_features_failed[row])
+                   + [NO_RECO_REASON_CODE_REMARK] * int(columns.no_reco_reason_code_failed[row])
+                   + [DATA_QUALITY_REMARK] * int(columns.remark_failed[row]))
+        failure_remarks[row] = '; '.join(remarks)
+    for row in np.flatnonzero(columns.fallback):
+        try:
+            remarks = get_output_field_remarks(outputs[row], calendar)
+            failure_remarks[row] = '; '.join(remarks) if remarks else None
+        except Exception:
+            failure_remarks[row] = traceback.format_exc()
+    return failure_remarks
+
+
+def get_business_policy_failure_remarks(outputs: list, columns: OutputColumns, rows: np.ndarray) -> list:
+    """
+    Remark of every row failing the business policies of get_business_policy_remarks, None for the rows which pass.
+    Only the given rows are validated.
+    """
+    failure_remarks = [None] * len(outputs)
+    selected = np.zeros(len(outputs), dtype=bool)
+    selected[rows] = True
+    liquidation_price = np.full(len(outputs), np.nan)
+    department_nbr = {}
+    for row in np.flatnonzero(selected & ~columns.fallback):
+        output = outputs[row]
+        if is_number(output['liquidation_price']) and 'department_nbr' in output['model_features']:
+            liquidation_price[row] = output['liquidation_price']
+            department_nbr[row] = output['model_features']['department_nbr']
+    columnar = selected & ~np.isnan(liquidation_price)
+
+    recommendation_rows = columns.recommendation_rows
+    in_batch = columnar[recommendation_rows]
+    rows_of_recommendations = recommendation_rows[in_batch]
+    prices = columns.recommendation_prices[in_batch]
+    current_retail_price = columns.current_retail_price[rows_of_recommendations]
+    max_price_failed = columns.count_per_row(rows_of_recommendations, (
+            (prices > current_retail_price * (100 - Settings.min_percent_discount) / 100 + 0.01)
+            | (prices > current_retail_price - Settings.min_dollar_discount + 0.01))) > 0
+    min_markdown_price = np.zeros(len(outputs))
+    for row, department in department_nbr.items():
+        min_markdown_price[row] = Settings.min_markdown_price.get(str(department), 0) - 0.01
+    min_price_failed = columns.count_per_row(rows_of_recommendations, (
+            (prices < liquidation_price[rows_of_recommendations] * (1 + Settings.buffer_percent_over_liquidation / 100)
+             - 0.01)
+            | (prices < min_markdown_price[rows_of_recommendations]))) > 0
+    ninety_nine_cent_failed = np.zeros(len(outputs), dtype=bool)
+    for row, price in zip(rows_of_recommendations.tolist(), prices.tolist()):
+        if not ninety_nine_cent_failed[row] and is_equal(int(price) + 0.99, price):
+            ninety_nine_cent_failed[row] = True
+
+    for row in np.flatnonzero(columnar):
+        remarks = []
+        if max_price_failed[row]:
+            remarks.append("No price recommendation within allowable range.")
+        if min_price_failed[row]:
+            remarks.append('No price recommendation within allowable range')
+        if ninety_nine_cent_failed[row]:
+            remarks.append(PRICE_ENDING_REMARK)
+        remarks.extend(validate_critical_price_point_policy(outputs[row]))
+        if remarks:
+            failure_remarks[row] = '; '.join(remarks)
+    for row in np.flatnonzero(selected & ~columnar):
+        remarks = get_business_policy_remarks(outputs[row])
+        if remarks:
+            failure_remarks[row] = '; '.join(remarks)
+    return failure_remarks
+
+
+def validate_output_batch(input_data: Dict[str, ItemClub], output_data: Dict[str, dict],
+                          calendar: CalendarContext = None) -> Dict[str, dict]:
+    """
+    Columnar version of validate_output, which applies the same rules to the whole batch at once. Fields the rules need
+    are read into arrays in one pass over the outputs, dates are parsed once per distinct date and the rules are
+    evaluated as array operations. Every rule yields a mask of the failing rows, remarks and dummy outputs are only
+    built for the failing rows. Output is the same as validate_output.
+    """
+    logger.debug("Validation the output generated")
+    calendar = calendar or CalendarContext()
+    if len(input_data) != len(output_data):
+        logger.error("We've encountered a problem with the output values in this plan ID. Please create a support incident through the Help menu for this issue.")
+    output_data = {key: value for key, value in output_data.items() if key in input_data}
+    for request_id in input_data.keys() - output_data.keys():
+        output_data[request_id] = get_dummy_output(input_data[request_id], 'unexpected_error', OUTPUT_MISMATCH_REMARK)
+
+    request_ids = list(output_data)
+    outputs = list(output_data.values())
+    mismatch = get_output_mismatch_mask([input_data[request_id] for request_id in request_ids], outputs)
+    failure_remarks = [OUTPUT_MISMATCH_REMARK if failed else None for failed in mismatch]
+
+    # Dummy outputs pass the output field rules, so only the rows which passed so far are validated further
+    columns = OutputColumns(outputs, calendar)
+    for row, remark in enumerate(get_output_field_failure_remarks(outputs, columns, calendar)):
+        if failure_remarks[row] is None:
+            failure_remarks[row] = remark
+    policy_rows = np.array([row for row, output in enumerate(outputs) if failure_remarks[row] is None and
+                            output['no_reco_reason_code'] == 'recommendation_successful'], dtype=np.int64)
+    for row, remark in enumerate(get_business_policy_failure_remarks(outputs, columns, policy_rows)):
+        if remark is not None:
+            failure_remarks[row] = remark
+
+    for request_id, remark in zip(request_ids, failure_remarks):
+        if remark is not None:
+            output_data[request_id] = get_dummy_output(input_data[request_id], 'unexpected_error', remark)
+    return output_data
+
+
+def to_json_float(value: float):
+    """
+    Float as written by DataFrame.to_json: rounded to 10 decimals, or to 10 significant digits below 1e-15 and from
+    1e16 on. NaN and infinite values become None.
+    """
+    if not math.isfinite(value):
+        return None
+    if value == 0:
+        return 0.0
+    if not 1e-15 <= abs(value) < 1e16:
+        return float(f'{value:.10g}')
+    return round(value, 10)
+
+
+def to_json_value(value):
+    """
+    Value as a JSON native Python object. numpy scalars are converted, floats are rounded by to_json_float and missing
+    values (None, NaN, pd.NA) become None, like in to_json
+    """
+    value_type = type(value)
+    if value_type in JSON_SCALAR_TYPES:
+        return value
+    if value_type is float:
+        return to_json_float(value)
+    if isinstance(value, dict):
+        return {key: to_json_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [to_json_value(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is pd.NA:
+        return None
+    if isinstance(value, float):
+        return to_json_float(value)
+    return value
+
+
+def get_output_column_values(column: pd.core.series.Series) -> list:
+    """
+    Values of the column as JSON native Python objects. Object columns (lists and dicts) are converted value by value,
+    the other ones only have their floats rounded
+    """
+    if column.dtype == object:
+        return [to_json_value(value) for value in column.tolist()]
+    values = column.astype(object).where(column.notna(), None).tolist()
+    values = [value.item() if isinstance(value, np.generic) else value for value in values]
+    return [to_json_float(value) if type(value) is float else value for value in values]
+
+
+def format_output_as_dict(data: pd.core.frame.DataFrame, calendar: CalendarContext = None) -> dict:
     """
     Format the output in a form defined in the V3 API I/O doc
 
+    The payload is built straight from the columns of the DataFrame, as JSON native Python objects, so that it is
+    serialized only once, by the response.
+
     :param data:
+    :param calendar:
     :return:
     """
-    output_json = (data
-                   .assign(misc=pd.NA)
-                   .set_index('request_id')
-                   # Keep only the columns same as the one in Settings.output_cols.
-                   # If any column in Settings.output_cols is not present in the given Dataframe, then create it.
-                   # Reindex function does both the jobs.
-                   .reindex(columns=Settings.output_cols)
-                   .convert_dtypes()
-                   .to_json(orient='index')
-                   )
-    output_dict = json.loads(output_json)
-    today = datetime.date.today()
-    # Formulate week_level_expected_sale_units in the required output format
-    for request_id, output in output_dict.items():
-        if output['week_level_expected_sale_units']:
-            output['week_level_expected_sale_units'] = [
-                dict(start_date=(today + datetime.timedelta(days=week_index * 7)).strftime("%Y-%m-%d"),
-                     end_date=(today + datetime.timedelta(days=week_index * 7 + 6)).strftime("%Y-%m-%d"),
-                     expected_sale_units=sale) for week_index, sale in
-                enumerate(output['week_level_expected_sale_units'])]
-            output['week_level_expected_sale_units'][-1]['end_date'] = output['oos_date']
-        if  output['expected_sale_units']:
-            output['expected_sale_units'] = int(output['expected_sale_units'])            
+    calendar = calendar or CalendarContext()
+    num_rows = len(data)
+    # Keep only the columns same as the one in Settings.output_cols. If any column in Settings.output_cols is not
+    # present in the given Dataframe, then it is null.
+    columns = {column: get_output_column_values(data[column]) if column in data else [None] * num_rows
+               for column in Settings.output_cols}
+    # misc carries the version of the model which generated the recommendation
+    if 'model_version' in data:
+        columns['misc'] = [dict(model_version=model_version) if model_version is not None else None
+                           for model_version in get_output_column_values(data['model_version'])]
+    # Same as the output of the convert_dtypes and to_json round trip this replaced: a column of whole numbers is
+    # written as ints. Otherwise non zero sales are truncated to ints and a zero sale stays a float, which fails
+    # validate_expected_sale_units.
+    sales_are_whole = ('expected_sale_units' in data and
+                       pd.api.types.is_integer_dtype(data['expected_sale_units'].convert_dtypes()))
+    columns['expected_sale_units'] = [int(sale) if sale or (sales_are_whole and sale is not None) else sale
+                                      for sale in columns['expected_sale_units']]
 
-    return output_dict
+    # Formulate week_level_expected_sale_units in the required output format
+    weekly_sales = columns['week_level_expected_sale_units']
+    week_boundaries = calendar.get_week_boundaries(max((len(sales) for sales in weekly_sales if sales), default=0))
+    for row, (sales, oos_date) in enumerate(zip(weekly_sales, columns['oos_date'])):
+        if sales:
+            weeks = [dict(start_date=start_date, end_date=end_date, expected_sale_units=sale)
+                     for (start_date, end_date), sale in zip(week_boundaries, sales)]
+            weeks[-1]['end_date'] = oos_date
+            weekly_sales[row] = weeks
+
+    return {request_id: dict(zip(columns, values))
+            for request_id, values in zip(get_output_column_values(data['request_id']), zip(*columns.values()))}
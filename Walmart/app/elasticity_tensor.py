@@ -0,0 +1,158 @@
+import datetime
+from itertools import chain
+from typing import NamedTuple
+
+import numpy as np
+
+from src.v3.calendar_context import CalendarContext
+
+ELASTICITY_COLUMNS = ['session_level_units_sold', 'session_prices', 'session_dividing_dates', 'week_level_units_sold']
+
+
+def pad_lists(lists: list, dtype, fill_value) -> tuple:
+    """
+    Stack a list of variable length lists into a 2D array padded with fill_value
+    :return: Tuple of (padded array, length of each list)
+    """
+    lengths = np.fromiter((len(values) for values in lists), dtype=np.int64, count=len(lists))
+    max_length = int(lengths.max()) if len(lengths) else 0
+    padded = np.full((len(lists), max_length), fill_value, dtype=dtype)
+    padded[np.arange(max_length) < lengths[:, None]] = np.fromiter(chain.from_iterable(lists), dtype=dtype,
+                                                                   count=int(lengths.sum()))
+    return padded, lengths
+
+
+class ElasticityTensor():
+    """
+    Dense representation of the elasticity curves of a batch of requests.
+
+    Every list column of the elasticity data is stored as an array of shape (request x price point x session/week),
+    padded up to the longest list, along with the length of each list. Session dividing dates are stored as date
+    ordinals. Units and prices stay float64 since they end up in the response and revenue ties are resolved on their
+    exact values, float32 is not safe for them.
+
+    The tensor is built once per batch by get_expected_sale, from the per-request DataFrames the elasticity engine
+    generates, and every row of the batch refers to its curve in it through an ElasticityCurve. The optimizer takes the
+    rows it is given out of the tensor, so the curves are not converted again.
+    """
+
+    def __init__(self, num_price_points: np.ndarray, num_sessions: np.ndarray, session_level_units_sold: np.ndarray,
+                 session_prices: np.ndarray, num_dividing_dates: np.ndarray, session_dividing_dates: np.ndarray,
+                 num_weeks: np.ndarray, week_level_units_sold: np.ndarray):
+        self.num_price_points = num_price_points
+        self.num_sessions = num_sessions
+        self.session_level_units_sold = session_level_units_sold
+        self.session_prices = session_prices
+        self.num_dividing_dates = num_dividing_dates
+        self.session_dividing_dates = session_dividing_dates
+        self.num_weeks = num_weeks
+        self.week_level_units_sold = week_level_units_sold
+        self.mask = np.arange(session_prices.shape[1]) < num_price_points[:, None]
+
+    @classmethod
+    def from_frames(cls, frames: list, calendar: CalendarContext = None) -> 'ElasticityTensor':
+        """
+        Build the tensor from the per-request elasticity DataFrames generated by the elasticity engine. Session
+        dividing dates are parsed through the calendar of the batch, so every distinct date is parsed once
+        """
+        calendar = calendar or CalendarContext()
+        num_price_points = np.array([len(frame) for frame in frames], dtype=np.int64)
+        num_requests = len(frames)
+        max_price_points = int(num_price_points.max()) if num_requests else 0
+        request_index = np.repeat(np.arange(num_requests), num_price_points)
+        price_point_index = np.arange(len(request_index)) - np.repeat(np.cumsum(num_price_points) - num_price_points,
+                                                                      num_price_points)
+        columns = {column: list(chain.from_iterable(frame[column] for frame in frames))
+                   for column in ELASTICITY_COLUMNS}
+        dividing_dates = [[calendar.get_date_ordinal(date) for date in dates]
+                          for dates in columns['session_dividing_dates']]
+
+        def to_dense(lists: list, dtype, fill_value) -> tuple:
+            padded, lengths = pad_lists(lists, dtype, fill_value)
+            dense = np.full((num_requests, max_price_points, padded.shape[1]), fill_value, dtype=dtype)
+            dense[request_index, price_point_index] = padded
+            dense_lengths = np.zeros((num_requests, max_price_points), dtype=np.int16)
+            dense_lengths[request_index, price_point_index] = lengths
+            return dense, dense_lengths
+
+        session_level_units_sold, num_sessions = to_dense(columns['session_level_units_sold'], np.float64, 0)
+        session_prices, _ = to_dense(columns['session_prices'], np.float64, 0)
+        session_dividing_dates, num_dividing_dates = to_dense(dividing_dates, np.int32, -1)
+        week_level_units_sold, num_weeks = to_dense(columns['week_level_units_sold'], np.float64, np.nan)
+        return cls(num_price_points, num_sessions, session_level_units_sold, session_prices, num_dividing_dates,
+                   session_dividing_dates, num_weeks, week_level_units_sold)
+
+    @classmethod
+    def from_curves(cls, curves: list) -> 'ElasticityTensor':
+        """
+        Tensor of the given curves, in their order. All of them must come from the tensor of the same batch.
+        """
+        tensors = {id(curve.tensor): curve.tensor for curve in curves}
+        if len(tensors) != 1:
+            raise ValueError(f"Elasticity curves come from {len(tensors)} tensors, expected the tensor of one batch")
+        tensor = next(iter(tensors.values()))
+        rows = np.fromiter((curve.row for curve in curves), dtype=np.int64, count=len(curves))
+        if len(rows) == len(tensor.num_price_points) and np.array_equal(rows, np.arange(len(rows))):
+            return tensor
+        return tensor.take(rows)
+
+    def take(self, rows: np.ndarray) -> 'ElasticityTensor':
+        """
+        Tensor of the given requests only
+        """
+        return ElasticityTensor(self.num_price_points[rows], self.num_sessions[rows],
+                                self.session_level_units_sold[rows], self.session_prices[rows],
+                                self.num_dividing_dates[rows], self.session_dividing_dates[rows], self.num_weeks[rows],
+                                self.week_level_units_sold[rows])
+
+    def get_curves(self) -> list:
+        """
+        ElasticityCurve of every request of the tensor, in order
+        """
+        return [ElasticityCurve(self, row) for row in range(len(self.num_price_points))]
+
+    def get_expected_sale_units(self) -> np.ndarray:
+        """
+        Sum of the session level units of every price point. Sessions are added left to right like the builtin sum,
+        so the values are bit for bit the same as summing the lists.
+        """
+        expected_sale_units = np.zeros(self.session_prices.shape[:2], dtype=np.float64)
+        for session_index in range(self.session_prices.shape[2]):
+            expected_sale_units = expected_sale_units + self.session_level_units_sold[:, :, session_index]
+        return expected_sale_units
+
+    def get_session_revenue(self) -> np.ndarray:
+        """
+        Dot product of session level units and session prices of every price point. Price points are grouped by their
+        number of sessions and each group goes through one batched matmul over the unpadded sessions, which gives the
+        same values as np.dot on the lists.
+        """
+        session_revenue = np.zeros(self.session_prices.shape[:2], dtype=np.float64)
+        for num_sessions in np.unique(self.num_sessions[self.mask]):
+            index = np.nonzero(self.mask & (self.num_sessions == num_sessions))
+            units = self.session_level_units_sold[index][:, :num_sessions]
+            prices = self.session_prices[index][:, :num_sessions]
+            session_revenue[index] = np.matmul(units[:, None, :], prices[:, :, None])[:, 0, 0]
+        return session_revenue
+
+    def get_session_prices(self, request: int, price_point: int) -> list:
+        return self.session_prices[request, price_point, :self.num_sessions[request, price_point]].tolist()
+
+    def get_session_level_units_sold(self, request: int, price_point: int) -> list:
+        return self.session_level_units_sold[request, price_point, :self.num_sessions[request, price_point]].tolist()
+
+    def get_session_dividing_dates(self, request: int, price_point: int) -> list:
+        return [datetime.date.fromordinal(date).strftime("%Y-%m-%d") for date in
+                self.session_dividing_dates[request, price_point, :self.num_dividing_dates[request, price_point]]
+                .tolist()]
+
+    def get_week_level_units_sold(self, request: int, price_point: int) -> list:
+        return self.week_level_units_sold[request, price_point, :self.num_weeks[request, price_point]].tolist()
+
+
+class ElasticityCurve(NamedTuple):
+    """
+    Elasticity curve of one request, as its row in the ElasticityTensor of the batch
+    """
+    tensor: ElasticityTensor
+    row: int
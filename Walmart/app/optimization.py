@@ -1,66 +1,94 @@
 # optimization
-import datetime
-
 import numpy as np
 import pandas as pd
 
 from src.config import Settings
+from src.v3.calendar_context import CalendarContext
+from src.v3.elasticity_tensor import ElasticityTensor
 
 
-
-def calculate_revenue(df: pd.core.frame.DataFrame, liquidation_price: float) -> pd.core.series.Series:
-
-
-    revenue = df.apply(lambda x: np.dot(x['session_level_units_sold'], x['session_prices']) + x[
-        'expected_liquidation_sale'] * liquidation_price, axis=1)
-    return revenue
-
-
-def get_optimal_point(club_item_data: pd.core.series.Series) -> pd.core.series.Series:
+def get_optimal_points(data: pd.core.frame.DataFrame, calendar: CalendarContext = None) -> pd.core.frame.DataFrame:
     """
-    Function identifies the price point which optimises the objective metric subject to business constrains
+    Function identifies the price point of every row which optimises the objective metric subject to business
+    constrains
 
     We refer to a combination corresponding to some markdown start date and some markdown price as a price point. If the
     sell_through_threshold is not given, we set the sell_through_threshold to default one. First we filter those price
     points which have expected sell through more than the sell_through_threshold. If all price points have expected sell
     through less than sell_through_threshold, we keep the price point corresponding to maximum expected sell through.
     Among the filtered price points, we pick the price point with maximum expected revenue. In case of tie for revenue
-    metric, we pick the price point having lesser markdown price and earlier markdown start date.
+    metric, we pick the price point having higher markdown price and earlier markdown start date.
+
+    Elasticity curves of the rows are taken out of the ElasticityTensor (request x price point x session) built by
+    get_expected_sale, through the elasticity_curve column. Sell through, revenue and the selection of the price point
+    with maximum expected revenue are then computed as array reductions over it. The tie break on markdown price and
+    start date is only run for the rows which have a revenue tie.
 
-    Following fields are added to the given pandas series:
-    1. markdown_recommendation
-    2. expected_sale_units
-    3. expected_revenue
+    Rows for which no price point can be selected are set to unexpected_error instead of failing the whole batch.
 
-    :param club_item_data:
+    :param data:
+    :param calendar:
     :return:
     """
-    elasticity_data = club_item_data['elasticity_data']
-    current_inventory = club_item_data['current_inventory']
-    liquidation_price = club_item_data['liquidation_price']
-    input_stt = club_item_data['sell_through_threshold']
-    sell_through_threshold = Settings.default_sell_through_threshold if pd.isna(input_stt) else input_stt
-    max_revenue_data = (
-        elasticity_data
-        .assign(expected_sale_units=lambda x: x['session_level_units_sold'].apply(sum))
-        .assign(expected_sell_through=lambda x: x['expected_sale_units'] / current_inventory)
-        .assign(sell_through_threshold=lambda x: min(max(x['expected_sell_through']), sell_through_threshold))
-        .query("expected_sell_through >= sell_through_threshold")
-        .assign(expected_liquidation_sale=lambda x: current_inventory - x['expected_sale_units'])
-        .assign(expected_revenue=lambda x: calculate_revenue(x, liquidation_price))
-        .loc[lambda x: x['expected_revenue'] == x['expected_revenue'].max()]
-        # In case of tie for revenue metric, we pick the price point having higher markdown_price and
-        # earlier markdown start date
-        .loc[lambda x: x['session_prices'].map(tuple) == tuple(x['session_prices'].max())]
-        .loc[lambda x: x['session_dividing_dates'].map(tuple) == tuple(x['session_dividing_dates'].min())]
-    )
-    session_dividing_dates = max_revenue_data.iloc[0]['session_dividing_dates']
-    today = datetime.date.today().strftime("%Y-%m-%d")
-    recommended_md_start_date = session_dividing_dates[0] if session_dividing_dates else today
-    recommended_markdown_price = max_revenue_data.iloc[0]['session_prices'][-1]
-    club_item_data['markdown_recommendation'] = [dict(markdown_session_start_date=recommended_md_start_date,
-                                                      recommended_markdown_price=recommended_markdown_price)]
-    club_item_data['expected_sale_units'] = max_revenue_data.iloc[0]['expected_sale_units']
-    club_item_data['expected_revenue'] = max_revenue_data.iloc[0]['expected_revenue']
-    club_item_data['week_level_expected_sale_units'] = max_revenue_data.iloc[0]['week_level_units_sold']
-    return club_item_data
+    if data.empty:
+        return data
+    calendar = calendar or CalendarContext()
+    elasticity = ElasticityTensor.from_curves(list(data['elasticity_curve']))
+    current_inventory = data['current_inventory'].to_numpy(dtype=np.float64, na_value=np.nan)[:, None]
+    liquidation_price = data['liquidation_price'].to_numpy(dtype=np.float64, na_value=np.nan)[:, None]
+    sell_through_threshold = data['sell_through_threshold'].to_numpy(dtype=np.float64, na_value=np.nan)
+    sell_through_threshold = np.where(np.isnan(sell_through_threshold), Settings.default_sell_through_threshold,
+                                      sell_through_threshold)
+
+    expected_sale_units = elasticity.get_expected_sale_units()
+    expected_sell_through = expected_sale_units / current_inventory
+    valid_sell_through = elasticity.mask & ~np.isnan(expected_sell_through)
+    max_sell_through = np.where(valid_sell_through, expected_sell_through, -np.inf).max(axis=1, initial=-np.inf)
+    row_threshold = np.minimum(max_sell_through, sell_through_threshold)[:, None]
+    expected_liquidation_sale = current_inventory - expected_sale_units
+    expected_revenue = elasticity.get_session_revenue() + expected_liquidation_sale * liquidation_price
+    eligible = valid_sell_through & (expected_sell_through >= row_threshold) & ~np.isnan(expected_revenue)
+    max_revenue = np.where(eligible, expected_revenue, -np.inf).max(axis=1, initial=-np.inf)[:, None]
+    is_max_revenue = eligible & (expected_revenue == max_revenue)
+    num_max_revenue = is_max_revenue.sum(axis=1)
+
+    today = calendar.today_str
+    markdown_recommendation, expected_sale, revenue, week_level_expected_sale_units = [], [], [], []
+    no_winner = np.zeros(len(data), dtype=bool)
+    for row in range(len(data)):
+        if num_max_revenue[row] == 1:
+            winner = int(np.argmax(is_max_revenue[row]))
+        elif num_max_revenue[row] > 1:
+            # In case of tie for revenue metric, we pick the price point having higher markdown_price and
+            # earlier markdown start date
+            candidates = np.flatnonzero(is_max_revenue[row]).tolist()
+            max_prices = max(elasticity.get_session_prices(row, i) for i in candidates)
+            candidates = [i for i in candidates if elasticity.get_session_prices(row, i) == max_prices]
+            min_dates = min(elasticity.get_session_dividing_dates(row, i) for i in candidates)
+            candidates = [i for i in candidates if elasticity.get_session_dividing_dates(row, i) == min_dates]
+            winner = candidates[0]
+        else:
+            winner = None
+        if winner is None or elasticity.num_sessions[row, winner] == 0:
+            no_winner[row] = True
+            markdown_recommendation.append(None)
+            expected_sale.append(None)
+            revenue.append(None)
+            week_level_expected_sale_units.append(None)
+            continue
+        dividing_dates = elasticity.get_session_dividing_dates(row, winner)
+        markdown_session_start_date = dividing_dates[0] if dividing_dates else today
+        session_prices = elasticity.get_session_prices(row, winner)
+        markdown_recommendation.append([dict(markdown_session_start_date=markdown_session_start_date,
+                                             recommended_markdown_price=session_prices[-1])])
+        expected_sale.append(expected_sale_units[row, winner])
+        revenue.append(expected_revenue[row, winner])
+        week_level_expected_sale_units.append(elasticity.get_week_level_units_sold(row, winner))
+
+    return data.assign(markdown_recommendation=markdown_recommendation,
+                       expected_sale_units=expected_sale,
+                       expected_revenue=revenue,
+                       week_level_expected_sale_units=week_level_expected_sale_units,
+                       no_reco_reason_code=np.where(no_winner, 'unexpected_error', data['no_reco_reason_code']),
+                       remark=np.where(no_winner, 'No valid price point found in the elasticity curve',
+                                       data['remark']))
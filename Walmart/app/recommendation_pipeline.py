@@ -1,64 +1,108 @@
+import io
 import json
-import logging
 import time
 from datetime import timedelta
+from itertools import islice
 
+import numpy as np
 import pandas as pd
-from typing import Dict, Union
+from typing import Dict
 
 from src.v3.business_policy_utils import get_min_max_price, modify_reco_as_per_business_policy, \
     apply_business_policy_for_min_md_price
+from src.v3.calendar_context import CalendarContext
 from src.v3.data_model import ItemClub
-from src.v3.data_validation import validate_input, validate_output, format_output_as_dict
-from src.v3.optimization import get_optimal_point
+from src.v3.data_validation import validate_input_batch, validate_output_batch, format_output_as_dict
+from src.v3.optimization import get_optimal_points
+from src.v3.result_cache import get_cached_recommendations, cache_recommendations
 from src.v3.sale_prediction import get_expected_sale
+from src.metrics import stage_latency
+from src.log_config import get_logger, LazyMessage
 
 # Set Logging Configurations
-logger = logging.getLogger(__name__)
-handler = logging.StreamHandler()
-logger.setLevel(logging.INFO)
-format_ = logging.Formatter('%(asctime)s - [%(name)s] - [%(levelname)s] - %(message)s')
-handler.setFormatter(format_)
-logger.addHandler(handler)
+logger = get_logger(__name__)
 
 
-def outlier_manager(function):
+def get_frame_info(df: pd.core.frame.DataFrame) -> str:
+    buffer = io.StringIO()
+    df.info(buf=buffer)
+    return buffer.getvalue()
+
+
+class StageExecutor():
     """
-    Defines a decorator on top of the given function and returns that decorated function
-    :param function:
-    :return:
+    Runs the stages of the pipeline on a single DataFrame, only on the rows which still have no_reco_reason_code as
+    recommendation_successful.
+
+    The data is not split into valid and invalid rows and concatenated back after every stage. Each stage gets the
+    masked subset of the rows (or the whole DataFrame when every row is still successful) and its output is written back
+    in place to those rows, so the rows stay in input order. A stage must return one row for each row it was given, with
+    the same index. Number of rows given to every stage and number of rows still successful after it are kept in
+    stage_stats, and the time taken by every stage is observed in the stage latency histogram.
     """
 
-    def decorated_function(data: Union[pd.core.series.Series, pd.core.frame.DataFrame], *args, **kwargs) -> Union[
-        pd.core.series.Series, pd.core.frame.DataFrame]:
+    def __init__(self, data: pd.core.frame.DataFrame, pipeline: str = 'v3'):
+        self.data = data
+        self.pipeline = pipeline
+        self.stage_stats = []
+
+    def get_success_mask(self) -> np.ndarray:
+        return (self.data['no_reco_reason_code'] == 'recommendation_successful').fillna(False).to_numpy(dtype=bool)
+
+    def run(self, stage: str, function, row_wise: bool = False, **kwargs) -> 'StageExecutor':
         """
-        In the situation of given data being a pandas series, if the given data has no_reco_reason_code as
-        recommendation_successful then the given `function` is called and the output of the function is returned,
-        otherwise input data is returned as it is.
-
-        In case the given data is a dataframe, given `function` is applied only on those rows which have
-        no_reco_reason_code as recommendation_successful. Output of this function is concatenated with the rows of the
-        data that didn't have no_reco_reason_code as recommendation_successful, and then finally returned as output.
-        :param data:
-        :return:
+        Run the given stage on the successful rows
+        :param stage: Name of the stage, used in stage_stats
+        :param function: Stage function, called with a DataFrame or with each row if row_wise is True
+        :param row_wise: Apply the function on each row instead of calling it on the DataFrame
+        :return: The executor itself, so that the stages can be chained
         """
-        if isinstance(data, pd.core.series.Series):
-            if data['no_reco_reason_code'] == 'recommendation_successful':
-                return function(data, *args, **kwargs)
+        starttime = time.perf_counter()
+        mask = self.get_success_mask()
+        num_rows = int(mask.sum())
+        if num_rows:
+            all_rows = num_rows == len(mask)
+            subset = self.data if all_rows else self.data[mask]
+            if row_wise:
+                output = subset.apply(function, axis=1, **kwargs)
             else:
-                return data
-        elif isinstance(data, pd.core.frame.DataFrame):
-            valid_data = data[data['no_reco_reason_code'] == 'recommendation_successful']
-            invalid_data = data[data['no_reco_reason_code'] != 'recommendation_successful']
-            if valid_data.empty:
-                return invalid_data
+                output = function(subset, **kwargs)
+            if len(output) != num_rows or not output.index.equals(subset.index):
+                raise ValueError(f"Stage {stage} didn't return the rows it was given")
+            if all_rows:
+                self.data = output
             else:
-                return pd.concat([function(valid_data, *args, **kwargs), invalid_data])
+                self.write_back(mask, output)
+        seconds = time.perf_counter() - starttime
+        stage_latency.observe(seconds, pipeline=self.pipeline, stage=stage)
+        self.stage_stats.append(dict(stage=stage, input_rows=num_rows,
+                                     successful_rows=int(self.get_success_mask().sum()),
+                                     seconds=round(seconds, 6)))
+        return self
+
+    def write_back(self, mask: np.ndarray, output: pd.core.frame.DataFrame) -> None:
+        """
+        Write the output of a stage to the masked rows of the data, column by column
+        """
+        for column in output.columns:
+            values = output[column]
+            if column not in self.data:
+                # Rows the stage didn't run on get NaN, same as a concat would give
+                self.data[column] = values.reindex(self.data.index)
+            elif self.data[column].dtype == values.dtype:
+                self.data.loc[mask, column] = values
+            else:
+                # The stage changed the type of the column, rows it didn't run on keep their value
+                self.data[column] = values.reindex(self.data.index).where(mask, self.data[column])
 
-    return decorated_function
+    def log_stage_stats(self) -> None:
+        for stats in self.stage_stats:
+            logger.info(f"Stage {stats['stage']}: {stats['input_rows']} rows in, {stats['successful_rows']} successful "
+                        f"rows out, {stats['seconds']} seconds")
 
 
-def process_md_recommendation_pipeline(input_data: Dict[str, ItemClub],feature_store) -> Dict[str, dict]:
+def process_md_recommendation_pipeline(input_data: Dict[str, ItemClub],feature_store,
+                                       club_item_data: Dict[str, dict] = None) -> Dict[str, dict]:
     """
     Given the relevant details of the club items, this function identifies the optimal markdown price for the club item.
     If start date is not provided, function identifies the optimal start date as well.
@@ -66,19 +110,31 @@ def process_md_recommendation_pipeline(input_data: Dict[str, ItemClub],feature_s
     Input data is passed through a series of steps i.e. Expected sale calculation, business policy application, revenue
     optimisation etc. After all these steps we get the recommended markdown price and the recommended start date
 
+    Requests which were already answered with the same features and model on the same day are served from the result
+    cache, only the rest goes through the pipeline.
+
     :param input_data:
+    :param feature_store:
+    :param club_item_data: Output of fetch_club_item_data, if the club item info has already been fetched by the
+    caller
     :return:
     """
+    # Every stage works against the same dates, even if the batch crosses midnight
+    calendar = CalendarContext()
+    request_ids = list(input_data)
+    cached_outputs = get_cached_recommendations(input_data, calendar)
+    if cached_outputs:
+        input_data = {key: value for key, value in input_data.items() if key not in cached_outputs}
+        if not input_data:
+            return {request_id: cached_outputs[request_id] for request_id in request_ids}
     starttime = time.perf_counter()
     #Profiling below piece of code
 
     data_list = [dict(value.dict(), request_id=key) for key, value in input_data.items()]
-    logger.info("Sample input data:")
-    logger.info(json.dumps(data_list[:3], sort_keys=True, indent=4))
+    logger.debug("Sample input data:\n%s", LazyMessage(json.dumps, data_list[:3], sort_keys=True, indent=4))
 
     input_pd_df = pd.DataFrame(data_list)
-    logger.info("Input Dataframe info:")
-    logger.info(input_pd_df.info())
+    logger.debug("Input Dataframe info:\n%s", LazyMessage(get_frame_info, input_pd_df))
 
     #Profiling ends
     duration = timedelta(seconds=time.perf_counter()-starttime)
@@ -87,29 +143,33 @@ def process_md_recommendation_pipeline(input_data: Dict[str, ItemClub],feature_s
     starttime = time.perf_counter()
     #Profiling below piece of code
 
-    output_dict = (input_pd_df
-                   .assign(no_reco_reason_code='recommendation_successful',
-                           remark='')
-                   .convert_dtypes()
-                   # Input and output are pandas dataframe with same set of columns
-                   .apply(validate_input, axis=1)
-                   # Input and output are pandas dataframe and output has following additional columns:
-                   # 1. max_md_price, 2. min_md_price
-                   .apply(outlier_manager(get_min_max_price), axis=1)
-                   # Input and output are pandas dataframe and output has following additional columns:
-                   # 1. elasticity_data, 2. model_features
-                   .pipe(outlier_manager(get_expected_sale), feature_store=feature_store)
-                   # Input and output are pandas dataframe with same set of columns
-                   .apply(outlier_manager(apply_business_policy_for_min_md_price), axis=1)
-                   # Input and output are pandas dataframe and output has following additional columns:
-                   # 1. markdown_recommendation, 2. expected_sale_units, 3. expected_revenue,
-                   # 4. week_level_expected_sale_units
-                   .apply(outlier_manager(get_optimal_point), axis=1)
-                   # Input and output are pandas dataframe with same set of columns
-                   .apply(outlier_manager(modify_reco_as_per_business_policy), axis=1)
-                   # Input is a pandas dataframe and output is a dictionary
-                   .pipe(format_output_as_dict)
-                   )
+    stage_executor = StageExecutor(input_pd_df
+                                   .assign(no_reco_reason_code='recommendation_successful',
+                                           remark='')
+                                   .convert_dtypes())
+    (stage_executor
+     # Input and output are pandas dataframe with same set of columns
+     .run('validate_input', validate_input_batch, calendar=calendar)
+     # Input and output are pandas dataframe and output has following additional columns:
+     # 1. max_md_price, 2. min_md_price
+     .run('get_min_max_price', get_min_max_price, row_wise=True)
+     # Input and output are pandas dataframe and output has following additional columns:
+     # 1. elasticity_data, 2. model_features, 3. elasticity_curve
+     .run('get_expected_sale', get_expected_sale, feature_store=feature_store, calendar=calendar,
+          club_item_data=club_item_data)
+     # Input and output are pandas dataframe with same set of columns
+     .run('apply_business_policy_for_min_md_price', apply_business_policy_for_min_md_price, row_wise=True)
+     # Input and output are pandas dataframe and output has following additional columns:
+     # 1. markdown_recommendation, 2. expected_sale_units, 3. expected_revenue,
+     # 4. week_level_expected_sale_units
+     .run('get_optimal_point', get_optimal_points, calendar=calendar)
+     # Input and output are pandas dataframe with same set of columns
+     .run('modify_reco_as_per_business_policy', modify_reco_as_per_business_policy, row_wise=True)
+     )
+    stage_executor.log_stage_stats()
+    # Input is a pandas dataframe and output is a dictionary
+    with stage_latency.time(pipeline='v3', stage='format_output_as_dict'):
+        output_dict = format_output_as_dict(stage_executor.data, calendar)
     
     #Profiling ends
     duration = timedelta(seconds=time.perf_counter()-starttime)
@@ -119,12 +179,18 @@ def process_md_recommendation_pipeline(input_data: Dict[str, ItemClub],feature_s
     #Profiling below piece of code
 
     # TODO: Do exception handling for the complete code
-    output_dict = validate_output(input_data, output_dict)
+    with stage_latency.time(pipeline='v3', stage='validate_output'):
+        output_dict = validate_output_batch(input_data, output_dict, calendar)
 
     #Profiling ends
     duration = timedelta(seconds=time.perf_counter()-starttime)
     logger.info(f"Time taken to validate the output dataset as a dictionary: {duration} seconds!")
 
-    logger.info("Sample output data")
-    logger.info(json.dumps(dict(list(output_dict.items())[0:3]), sort_keys=True, indent=4))
+    sample_output = dict(islice(output_dict.items(), 3))
+    logger.debug("Sample output data:\n%s", LazyMessage(json.dumps, sample_output, sort_keys=True, indent=4))
+
+    cache_recommendations(input_data, output_dict, calendar)
+    if cached_outputs:
+        output_dict = {request_id: cached_outputs[request_id] if request_id in cached_outputs else
+                       output_dict[request_id] for request_id in request_ids}
     return output_dict
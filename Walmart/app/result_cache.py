@@ -0,0 +1,156 @@
+"""
+Description - Cache of the whole V3 recommendation of club item requests
+"""
+
+import hashlib
+import json
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Tuple
+
+from src.config import Settings
+from src.jyotish.feature_cache import club_item_feature_cache
+from src.jyotish.model_refresher import model_refresher
+from src.v3.calendar_context import CalendarContext
+from src.v3.data_model import ItemClub
+from src.log_config import get_logger
+from src.metrics import register_cache
+
+# Set Logging Configurations
+logger = get_logger(__name__)
+
+# Outputs which depend on something else than the request, the features and the model are not cached
+UNCACHED_NO_RECO_REASON_CODES = ['unexpected_error']
+
+
+def get_request_hash(input_data: ItemClub) -> str:
+    """Canonical hash of the fields of the request, independent of the field order"""
+    fields = json.dumps(input_data.dict(), sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.blake2b(fields.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class RecommendationResultCache():
+    """Bounded, thread safe cache of the V3 output of whole requests.
+
+    The same club item requests come back many times a day as planners refresh their plans, so outputs are cached by
+    the canonical hash of the request fields, the feature snapshot date of the club item, the model version and the
+    calendar day. A request whose key is found is served without going to the Feature Store or the model. Outputs are
+    stored pickled, so every hit gets its own copy and callers can't change the cached entries. Entries are evicted in
+    LRU order once their size goes beyond max_bytes.
+
+    Feature snapshot date is only known once the features of a club item are fetched, so it is looked up in the club
+    item feature cache. Requests whose club item has no unexpired row there are never served from this cache, which also
+    expires the results along with the features of the club item. When the feature cache is disabled, features are
+    daily snapshots fetched for every batch, and the as-of date of the request stands for their snapshot date.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_keys(self, input_data: Dict[str, ItemClub], model_version: str,
+                 calendar: CalendarContext) -> Dict[str, Tuple]:
+        """
+        Cache key of every request for which the feature snapshot date and the model version are known
+        :return: Key of the output dict is request_id and value is the cache key
+        """
+        if model_version is None:
+            return {}
+        if not Settings.enable_feature_cache:
+            return {request_id: (get_request_hash(value), calendar.today_str, str(model_version), calendar.today_str)
+                    for request_id, value in input_data.items()}
+        feature_dates = club_item_feature_cache.get_feature_dates(
+            set((value.club_nbr, value.customer_item_nbr) for value in input_data.values()))
+        keys = {}
+        for request_id, value in input_data.items():
+            feature_date = feature_dates.get((value.club_nbr, value.customer_item_nbr))
+            if feature_date is not None:
+                keys[request_id] = (get_request_hash(value), str(feature_date), str(model_version),
+                                    calendar.today_str)
+        return keys
+
+    def get_many(self, keys: Dict[str, Hashable]) -> Dict[str, dict]:
+        """
+        :param keys: Key of the dict is request_id and value is the cache key
+        :return: Cached output of the requests which were found, marked as served from the cache
+        """
+        found = {}
+        with self._lock:
+            for request_id, key in keys.items():
+                entry = self._entries.get(key)
+                if entry is None:
+                    self.misses += 1
+                    continue
+                self._entries.move_to_end(key)
+                self.hits += 1
+                found[request_id] = entry
+        # Every hit is unpickled into its own copy, which can be marked and changed by the caller
+        for request_id, payload in found.items():
+            output = pickle.loads(payload)
+            output['misc'] = dict(output.get('misc') or {}, served_from_cache=True)
+            found[request_id] = output
+        return found
+
+    def put_many(self, input_data: Dict[str, ItemClub], output_data: Dict[str, dict], calendar: CalendarContext):
+        """Cache the outputs of the requests computed by the pipeline, under the model version they were generated by"""
+        entries = {}
+        for model_version in set((output.get('misc') or {}).get('model_version') for output in output_data.values()):
+            outputs = {request_id: output for request_id, output in output_data.items()
+                       if (output.get('misc') or {}).get('model_version') == model_version and
+                       output.get('no_reco_reason_code') not in UNCACHED_NO_RECO_REASON_CODES}
+            keys = self.get_keys({request_id: input_data[request_id] for request_id in outputs}, model_version,
+                                 calendar)
+            entries.update({key: pickle.dumps(outputs[request_id], protocol=pickle.HIGHEST_PROTOCOL)
+                            for request_id, key in keys.items()})
+        with self._lock:
+            for key, payload in entries.items():
+                previous = self._entries.pop(key, None)
+                if previous is not None:
+                    self.size_bytes -= sys.getsizeof(previous)
+                self._entries[key] = payload
+                self.size_bytes += sys.getsizeof(payload)
+            while self._entries and self.size_bytes > self.max_bytes:
+                _, payload = self._entries.popitem(last=False)
+                self.size_bytes -= sys.getsizeof(payload)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(size=len(self._entries), size_bytes=self.size_bytes, max_bytes=self.max_bytes, hits=self.hits,
+                        misses=self.misses, evictions=self.evictions,
+                        hit_ratio=round(self.hits / lookups, 4) if lookups else 0.0)
+
+
+recommendation_result_cache = RecommendationResultCache(max_bytes=Settings.result_cache_max_bytes)
+register_cache('recommendation_results', recommendation_result_cache.stats)
+
+
+def get_cached_recommendations(input_data: Dict[str, ItemClub], calendar: CalendarContext) -> Dict[str, dict]:
+    """Outputs of the requests which can be served from the result cache"""
+    if not Settings.enable_result_cache:
+        return {}
+    keys = recommendation_result_cache.get_keys(input_data, model_refresher.get_model_version(), calendar)
+    cached_outputs = recommendation_result_cache.get_many(keys)
+    logger.info(f"Result cache lookup: {len(cached_outputs)} of {len(input_data)} requests served from cache")
+    return cached_outputs
+
+
+def cache_recommendations(input_data: Dict[str, ItemClub], output_data: Dict[str, dict],
+                          calendar: CalendarContext) -> None:
+    if not Settings.enable_result_cache:
+        return
+    recommendation_result_cache.put_many(input_data, output_data, calendar)
+    logger.info(f"Result cache stats: {recommendation_result_cache.stats()}")
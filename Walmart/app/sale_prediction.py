@@ -1,58 +1,97 @@
-import json
-import logging
 
+import numpy as np
 import pandas as pd
+from typing import Dict
 
 from src.jyotish.data_model import ItemClubElasticity
 from src.jyotish.prediction_pipeline import PredictionPipeline
 from src.jyotish.requests_manager import RequestsManager
+from src.v3.calendar_context import CalendarContext
+from src.v3.data_model import ItemClub
+from src.v3.elasticity_tensor import ELASTICITY_COLUMNS, ElasticityTensor
+from src.log_config import get_logger
 
 # Set Logging Configurations
-logger = logging.getLogger(__name__)
-handler = logging.StreamHandler()
-logger.setLevel(logging.INFO)
-format_ = logging.Formatter('%(asctime)s - [%(name)s] - [%(levelname)s] - %(message)s')
-handler.setFormatter(format_)
-logger.addHandler(handler)
-
-def get_expected_sale(df: pd.core.frame.DataFrame,feature_store) -> pd.core.frame.DataFrame:
+logger = get_logger(__name__)
+
+ELASTICITY_OUTPUT_COLUMNS = ['elasticity_data', 'model_features', 'no_reco_reason_code', 'remark']
+EMPTY_ELASTICITY_DATA = pd.DataFrame(columns=ELASTICITY_COLUMNS)
+
+
+def get_column_values(column: pd.core.series.Series) -> list:
+    """
+    Values of the column as Python objects, with None for the missing values
     """
-    This function calls the elasticman API (API for getting the elasticity curve) for the rows in the given input
+    values = column.astype(object).where(column.notna(), None).tolist()
+    return [value.item() if isinstance(value, np.generic) else value for value in values]
+
+
+def fetch_club_item_data(input_data: Dict[str, ItemClub], feature_store) -> Dict[str, dict]:
+    """
+    Fetch the club item info of the requests ahead of the pipeline, so that the API runs this I/O bound part on its
+    feature I/O executor and only the CPU bound part on the pipeline executor. Requests which fail input validation
+    later on are fetched as well, they only cost a lookup of their club item.
+
+    :param input_data:
+    :param feature_store:
+    :return: Key of the output dict is request_id and value is club item info, as returned by
+    RequestsManager.get_club_item_data
+    """
+    requests_manager = RequestsManager(input_data, PredictionPipeline.process_elasticity_prediction_pipeline,
+                                       feature_store)
+    return requests_manager.get_club_item_data()
+
+
+def get_expected_sale(df: pd.core.frame.DataFrame,feature_store,
+                      calendar: CalendarContext = None, club_item_data: Dict[str, dict] = None
+                      ) -> pd.core.frame.DataFrame:
+    """
+    This function calls the elasticity engine (module for getting the elasticity curve) for the rows in the given input
     dataframe.
 
-    Input data is transformed in a format to pass to the elasticman API, then we call the elasticman API. The output of
-    the elasticman API is merged to the input dataframe which adds elasticity_data & model_features columns to the input
-    dataframe and sets the appropriate values to the no_reco_reason_code and remark column.
+    Relevant columns of the input are handed to the elasticity engine in memory, as lists of Python values, and its
+    results come back column wise. These are added to the input dataframe as elasticity_data & model_features columns,
+    along with the appropriate values of the no_reco_reason_code and remark column.
+
+    Elasticity curves of the whole batch are stacked here into one ElasticityTensor, and every row gets its curve in
+    it as the elasticity_curve column, which the optimizer works on. Rows without elasticity data get an empty curve.
 
     :param df:
+    :param feature_store:
+    :param calendar:
+    :param club_item_data: Output of fetch_club_item_data for a batch holding these rows, if it has already been
+    fetched by the caller. The club item info is fetched here otherwise.
     :return:
     """
-    relevant_columns = ['request_id', 'club_nbr', 'customer_item_nbr', 'md_start_date', 'oos_date', 'current_inventory',
+    relevant_columns = ['club_nbr', 'customer_item_nbr', 'md_start_date', 'oos_date', 'current_inventory',
                         'current_retail_price', 'min_md_price', 'max_md_price']
-    data_json = (df
-                 .filter(relevant_columns)
-                 .set_index('request_id')
-                 .convert_dtypes()
-                 .to_json(orient='index')
-                 )
-     
-    data_dict = json.loads(data_json)
 
     logger.info("Fetching the elasticity curve for the club items in the given input")
-    logger.info("Sample data before fetching the elasticity curve:")
-    # logger.info('\n' + df.head().transpose().to_markdown())
-    data_pydantic = {key: ItemClubElasticity.parse_obj(val) for key, val in data_dict.items()}
-    elasticity_generator = RequestsManager(data_pydantic, PredictionPipeline.process_elasticity_prediction_pipeline,feature_store)
-
-    elasticity_prediction = elasticity_generator.process_requests()
-
-    output_data = (pd.DataFrame(elasticity_prediction)
-                   .transpose()
-                   .rename_axis('request_id')
-                   .reset_index()
-                   .merge(df.drop(columns=['no_reco_reason_code', 'remark']), on='request_id', how='right')
+    # Requests are built from the columns in memory, without a JSON round trip
+    elasticity_generator = RequestsManager.from_columns(df['request_id'].tolist(),
+                                                        {column: get_column_values(df[column])
+                                                         for column in relevant_columns if column in df},
+                                                        ItemClubElasticity,
+                                                        PredictionPipeline.process_elasticity_prediction_pipeline,
+                                                        feature_store)
+
+    if club_item_data is not None:
+        club_item_data = {request_id: club_item_data.get(request_id, {}) for request_id in df['request_id'].tolist()}
+    # Rows whose club item info is incomplete are answered without going through the elasticity engine, their input
+    # already went through validate_input_batch
+    elasticity_prediction = elasticity_generator.process_requests_as_columns(
+        club_item_data, screen_request=PredictionPipeline.screen_elasticity_request)
+    elasticity_data = elasticity_prediction.get('elasticity_data', [None] * len(df))
+    elasticity = ElasticityTensor.from_frames([frame if isinstance(frame, pd.DataFrame) else EMPTY_ELASTICITY_DATA
+                                               for frame in elasticity_data], calendar)
+
+    output_data = (df
+                   .assign(**{column: elasticity_prediction.get(column, [None] * len(df))
+                              for column in ELASTICITY_OUTPUT_COLUMNS})
                    .fillna(dict(no_reco_reason_code='unexpected_error', remark='no_result_from_elasticman_API'))
+                   .assign(model_version=elasticity_generator.model_version)
                    .convert_dtypes()
+                   .assign(elasticity_curve=elasticity.get_curves())
                    )
 
     return output_data
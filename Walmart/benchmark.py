@@ -0,0 +1,254 @@
+"""
+Description - Offline stage level micro-benchmark of the V3 (and through get_expected_sale, the Jyotish) pipeline.
+
+Synthetic ItemClub batches are run through the stages of process_md_recommendation_pipeline with a stub Feature Store,
+a stub model and a stub elasticity engine, so no network access, credentials or model artefacts are needed. Time taken
+by every stage is written as JSON so that runs of different commits can be compared on the same machine.
+
+Usage: python -m src.benchmark --batch-sizes 1 100 1000 --output bench_output.json
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import math
+import platform
+import subprocess
+import sys
+import time
+import types
+
+import numpy as np
+import pandas as pd
+
+from src.config import Settings
+
+
+class StubElasticityPredictor():
+    """Stands in for the elasticity engine of src.jyotish.sale_predictor, which needs the trained model artefacts.
+
+    Candidates are the prices of a ladder between the min and max markdown price, for every weekly markdown start date
+    which leaves at least 6 days to the out-of-stock date (or only the given md_start_date). Sale units of every
+    candidate are predicted by the model in one call and returned as elasticity curves in the format of the engine,
+    with a session at the current retail price before the markdown start date.
+    """
+
+    def __init__(self, input_data, club_item_data: dict, model_data: dict):
+        self.input_data = input_data
+        self.club_item_data = club_item_data
+        self.model = model_data['model']
+
+    def get_start_dates(self, today: datetime.date, oos_date: datetime.date) -> list:
+        if self.input_data.md_start_date is not None:
+            return [datetime.date.fromisoformat(self.input_data.md_start_date)]
+        start_dates = [today + datetime.timedelta(days=7 * week) for week in range(Settings.n_prediction_weeks)]
+        return [start_date for start_date in start_dates if (oos_date - start_date).days >= 6] or [today]
+
+    def get_elasticity_prediction(self) -> tuple:
+        today = datetime.date.today()
+        oos_date = datetime.date.fromisoformat(self.input_data.oos_date)
+        current_inventory = self.input_data.current_inventory
+        current_retail_price = self.input_data.current_retail_price
+        min_md_price = getattr(self.input_data, 'min_md_price', None) or round(0.5 * current_retail_price, 2)
+        max_md_price = getattr(self.input_data, 'max_md_price', None) or round(0.95 * current_retail_price, 2)
+        prices = np.round(np.linspace(min_md_price, max_md_price, 5), 2).tolist()
+        candidates = [(start_date, price) for start_date in self.get_start_dates(today, oos_date) for price in prices]
+
+        features = pd.DataFrame({
+            Settings.discount_feature_format.format(1): [1 - price / current_retail_price for _, price in candidates],
+            Settings.num_weeks_feature: [max(1, math.ceil((oos_date - start_date).days / 7))
+                                         for start_date, _ in candidates]})
+        markdown_units = self.model.predict(features)
+        num_weeks = max(1, math.ceil(((oos_date - today).days + 1) / 7))
+        rows = []
+        for (start_date, price), units in zip(candidates, markdown_units):
+            pre_markdown_units = min(0.5 * (start_date - today).days / 7, current_inventory)
+            units = min(float(units), current_inventory - pre_markdown_units)
+            rows.append(dict(session_level_units_sold=[pre_markdown_units, units],
+                             session_prices=[current_retail_price, price],
+                             session_dividing_dates=[start_date.strftime("%Y-%m-%d")],
+                             week_level_units_sold=[(pre_markdown_units + units) / num_weeks] * num_weeks))
+        model_features = dict(department_nbr=self.club_item_data.get('department_nbr'))
+        return pd.DataFrame(rows), model_features, 'recommendation_successful', ''
+
+
+class StubSalePredictor(StubElasticityPredictor):
+    """Stands in for the V2 sale predictor of src.jyotish.sale_predictor. Sale units of the club item at its current
+    retail price over the prediction weeks are predicted by the model, and capped by the inventory."""
+
+    def get_sale_prediction(self) -> tuple:
+        features = pd.DataFrame({Settings.discount_feature_format.format(1): [0.0],
+                                 Settings.num_weeks_feature: [Settings.n_prediction_weeks]})
+        expected_sale = min(float(self.model.predict(features)[0]), self.input_data.current_inventory)
+        model_features = dict(department_nbr=self.club_item_data.get('department_nbr'))
+        return int(expected_sale), None, model_features, ''
+
+
+def install_stub_elasticity_engine() -> None:
+    """
+    Register the stub engine as src.jyotish.sale_predictor, before the pipeline modules import it. Process pool workers
+    import this module again as their main module, so they get the stub as well.
+    """
+    module = types.ModuleType('src.jyotish.sale_predictor')
+    module.ElasticityPredictor = StubElasticityPredictor
+    module.SalePredictor = StubSalePredictor
+    sys.modules[module.__name__] = module
+
+
+install_stub_elasticity_engine()
+
+from src.jyotish.feature_cache import club_item_feature_cache
+from src.jyotish.model_refresher import model_refresher
+from src.v3.business_policy_utils import get_min_max_price, modify_reco_as_per_business_policy, \
+    apply_business_policy_for_min_md_price
+from src.v3.calendar_context import CalendarContext
+from src.v3.data_model import ItemClub
+from src.v3.data_validation import validate_input_batch, validate_output_batch, format_output_as_dict
+from src.v3.optimization import get_optimal_points
+from src.v3.recommendation_pipeline import StageExecutor
+from src.v3.sale_prediction import get_expected_sale
+
+DEFAULT_BATCH_SIZES = [1, 100, 1000, 10000, 100000]
+CATEGORICAL_FEATURES = ['club_nbr', 'department_nbr', 'subclass_nbr', 'week', 'month']
+
+
+class StubFeatures():
+    def __init__(self, df: pd.core.frame.DataFrame):
+        self.df = df
+
+    def to_df(self) -> pd.core.frame.DataFrame:
+        return self.df
+
+
+class StubFeatureStore():
+    """Generates deterministic feature rows for the requested club items, in the format returned by FeatureMart"""
+
+    def get_online_features(self, entity_rows: list, features: list) -> StubFeatures:
+        club_nbrs = np.array([int(entity['club_nbr']) for entity in entity_rows], dtype=np.int64)
+        item_nbrs = np.array([int(entity['item_nbr']) for entity in entity_rows], dtype=np.int64)
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame({'club_nbr': club_nbrs, 'item_nbr': item_nbrs})
+        for feature in (feature.split(':')[-1] for feature in features):
+            if feature == 'date':
+                df[feature] = datetime.date.today().strftime("%Y-%m-%d")
+            elif feature == 'department_nbr':
+                df[feature] = item_nbrs % 90 + 1
+            elif feature == 'subclass_nbr':
+                df[feature] = item_nbrs % 40 + 1
+            else:
+                df[feature] = rng.uniform(0.5, 20, len(df))
+        return StubFeatures(df)
+
+
+class StubModel():
+    """Expected sale grows with the discount and the number of weeks, enough for the optimizer to pick a winner"""
+
+    def predict(self, features) -> np.ndarray:
+        features = pd.DataFrame(features)
+        discount = features.get(Settings.discount_feature_format.format(1), 0)
+        num_weeks = features.get(Settings.num_weeks_feature, 1)
+        return np.asarray(2 + 10 * np.abs(discount) + 0.5 * num_weeks, dtype=np.float64) * np.ones(len(features))
+
+
+def get_synthetic_batch(batch_size: int, seed: int = 0) -> dict:
+    """Synthetic V3 input. Around half of the requests come without md_start_date and some share club items."""
+    rng = np.random.default_rng(seed)
+    today = datetime.date.today()
+    batch = {}
+    for i in range(batch_size):
+        current_retail_price = round(float(rng.uniform(5, 100)), 2)
+        md_start_date = None
+        if rng.random() < 0.5:
+            md_start_date = (today + datetime.timedelta(days=int(rng.integers(0, 7)))).strftime("%Y-%m-%d")
+        batch[f'request_{i}'] = ItemClub(
+            club_nbr=str(4000 + int(rng.integers(0, 600))),
+            customer_item_nbr=str(980000000 + int(rng.integers(0, max(1, batch_size)))),
+            oos_date=(today + datetime.timedelta(days=int(rng.integers(14, 50)))).strftime("%Y-%m-%d"),
+            md_start_date=md_start_date,
+            sell_through_threshold=None if rng.random() < 0.5 else round(float(rng.uniform(0, 1)), 2),
+            current_inventory=int(rng.integers(10, 500)),
+            current_retail_price=current_retail_price,
+            liquidation_price=round(current_retail_price * float(rng.uniform(0, 0.3)), 2))
+    return batch
+
+
+def time_stage(timings: list, batch_size: int, stage: str, function, *args, **kwargs):
+    starttime = time.perf_counter()
+    output = function(*args, **kwargs)
+    seconds = time.perf_counter() - starttime
+    timings.append(dict(batch_size=batch_size, stage=stage, seconds=round(seconds, 6),
+                        rows_per_second=round(batch_size / seconds, 2) if seconds else None))
+    return output
+
+
+def run_pipeline_stages(input_data: dict, feature_store) -> list:
+    """Run the stages of process_md_recommendation_pipeline and time each of them"""
+    batch_size = len(input_data)
+    calendar = CalendarContext()
+    timings = []
+    df = (pd.DataFrame([dict(value.dict(), request_id=key) for key, value in input_data.items()])
+          .assign(no_reco_reason_code='recommendation_successful', remark='')
+          .convert_dtypes())
+    stage_executor = (StageExecutor(df)
+                      .run('validate_input', validate_input_batch, calendar=calendar)
+                      .run('get_min_max_price', get_min_max_price, row_wise=True)
+                      .run('get_expected_sale', get_expected_sale, feature_store=feature_store, calendar=calendar)
+                      .run('apply_business_policy_for_min_md_price', apply_business_policy_for_min_md_price,
+                           row_wise=True)
+                      .run('get_optimal_point', get_optimal_points, calendar=calendar)
+                      .run('modify_reco_as_per_business_policy', modify_reco_as_per_business_policy, row_wise=True))
+    for stats in stage_executor.stage_stats:
+        rows_per_second = round(stats['input_rows'] / stats['seconds'], 2) if stats['seconds'] else None
+        timings.append(dict(batch_size=batch_size, stage=stats['stage'], input_rows=stats['input_rows'],
+                            seconds=stats['seconds'], rows_per_second=rows_per_second))
+    output_dict = time_stage(timings, batch_size, 'format_output_as_dict', format_output_as_dict, stage_executor.data,
+                             calendar)
+    time_stage(timings, batch_size, 'validate_output', validate_output_batch, input_data, output_dict, calendar)
+    return timings
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline stage level benchmark of the V3 pipeline')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=DEFAULT_BATCH_SIZES)
+    parser.add_argument('--output', default='bench_output.json')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    # The stub Feature Store doesn't need credentials
+    Settings.feature_backend = 'benchmark'
+    feature_names = Settings.static_feature_names + [Settings.discount_feature_format.format(week) for week in
+                                                      Settings.forcast_duration]
+    feature_names += [Settings.num_weeks_feature, Settings.pre_sell_ratio_feature]
+    model_refresher.publish(dict(all_features=feature_names, categorical_features=CATEGORICAL_FEATURES,
+                                 model=StubModel()), 'benchmark')
+    feature_store = StubFeatureStore()
+
+    timings = []
+    for batch_size in args.batch_sizes:
+        # Every batch size starts with a cold feature cache
+        club_item_feature_cache.clear()
+        input_data = get_synthetic_batch(batch_size)
+        starttime = time.perf_counter()
+        batch_timings = run_pipeline_stages(input_data, feature_store)
+        batch_timings.append(dict(batch_size=batch_size, stage='total',
+                                  seconds=round(time.perf_counter() - starttime, 6)))
+        timings.extend(batch_timings)
+        print('\n'.join(f"{t['batch_size']:>7} {t['stage']:<36} {t['seconds']:>12.6f}s" for t in batch_timings))
+
+    results = dict(commit=get_commit(), timestamp=datetime.datetime.now().isoformat(),
+                   python=platform.python_version(), pandas=pd.__version__, timings=timings)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
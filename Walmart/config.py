@@ -69,6 +69,9 @@ class Settings:
                             'change_unit_sold_3_4_week_back_cnt',
                             'subclass_unit_sold_same_week_1_year_back_nbr']
 
+    # Static features which are decoded as integers, rest of the static features are decoded as floats
+    integer_feature_names = ['club_nbr', 'department_nbr', 'subclass_nbr', 'month', 'week']
+
     # These features are used in dynamic calculations
     discount_feature_format = 'discount_{}_week_next_nbr'
     num_weeks_feature = 'num_weeks'
@@ -140,6 +143,11 @@ class Settings:
 
     enable_historic_data_requests = False
     model_ttl = 24 * 60 * 60
+    # Model is reloaded in the background model_refresh_delay seconds after model_ttl runs out, failed reloads are
+    # retried after model_refresh_retry_interval seconds while the current model keeps being served
+    enable_background_model_refresh = True
+    model_refresh_delay = 60
+    model_refresh_retry_interval = 5 * 60
     max_forecast_weeks = 8
     default_sell_through_threshold = 0
     min_percent_discount = 10
@@ -147,6 +155,75 @@ class Settings:
     buffer_percent_over_liquidation = 20
     model_database_table = 'markdown.model_info_v3'
 
+    # Club item feature cache. sams_club_item_daily_v4 is refreshed once a day, rows are served from memory till the
+    # next snapshot is expected (feature date + 1 day + refresh lag)
+    enable_feature_cache = True
+    feature_cache_max_size = 200000
+    feature_cache_refresh_lag = 12 * 60 * 60
+    feature_cache_min_ttl = 60 * 60
+
+    # Whole V3 recommendations are cached, keyed by the request fields, feature snapshot date, model version and day.
+    # Least recently used results are evicted once their pickled size goes beyond result_cache_max_bytes.
+    enable_result_cache = True
+    result_cache_max_bytes = 512 * 1024 * 1024
+
+    # Large feature fetches are split into chunks which are fetched concurrently on a bounded thread pool
+    enable_chunked_feature_fetch = True
+    feature_fetch_chunk_size = 2000
+    feature_fetch_max_workers = 4
+    feature_fetch_max_retries = 2
+    feature_fetch_retry_backoff = 1
+
+    # Process pool used by RequestsManager.process_requests. Batches smaller than process_pool_min_batch_size are
+    # processed serially. If process_pool_chunk_size is None, chunk size is derived from the batch size. Pools are long
+    # lived. In the pre-fork server mode they are forked by every server worker and share the model of the master,
+    # otherwise (single process server, model version change) every one of their processes receives and holds a copy
+    # of the model, so memory grows by one model per process.
+    enable_process_pool = True
+    process_pool_workers = max(1, (os.cpu_count() or 1) - 1)
+    process_pool_chunk_size = None
+    process_pool_min_batch_size = 200
+
+    # Feature backend used by the APIs. 'feature_mart' serves features online from FeatureMart, 'snapshot' serves them
+    # from a local daily snapshot (Parquet or Arrow file) of sams_club_item_daily_v4, e.g. for nightly bulk runs
+    feature_backend = os.getenv('FEATURE_BACKEND', 'feature_mart')
+    feature_snapshot_path = os.getenv('FEATURE_SNAPSHOT_PATH')
+
+    # API executors and per endpoint concurrency limits. Batches above the concurrency limit of an endpoint wait in a
+    # queue of at most api_endpoint_max_queued batches, further batches are rejected with 503
+    api_feature_io_workers = 8
+    api_pipeline_workers = 4
+    api_endpoint_concurrency = {'v3': 2, 'v3_jyotish': 2, 'dotcom_prediction': 2, 'dotcom_optimization': 2,
+                                'v3_stream': 2}
+    api_endpoint_max_queued = 16
+
+    # Number of NDJSON lines of the streaming V3 endpoint which go through the pipeline together
+    api_stream_chunk_size = 1000
+
+    # Pre-fork server mode (python -m gunicorn -c python:src.gunicorn_conf src.app:app). The app module, model, feature
+    # schema and policy tables are loaded once in the master and shared copy-on-write by server_workers worker
+    # processes. 0 starts one worker per core available to the container. The feature and result caches are per worker,
+    # so their hit ratio goes down with the number of workers (see mdo_cache_lookups on /metrics) while their memory
+    # bounds apply to every worker.
+    server_workers = int(os.getenv('SERVER_WORKERS', 0))
+    server_bind = os.getenv('SERVER_BIND', '0.0.0.0:8000')
+    server_timeout = 600
+    server_graceful_timeout = 120
+
+    # Latency histograms and counters served on /metrics in the Prometheus text format. When metrics_dir is set (always
+    # in the pre-fork server mode), the values of all the processes writing to it are served added up.
+    enable_metrics = True
+    metrics_dir = os.getenv('METRICS_DIR')
+    metrics_snapshot_interval = 5
+
+    # Logging profile of the environment, which sets the log level and the share of the per row log lines that are
+    # kept. Records are written by a background thread unless enable_queue_logging is False.
+    log_profile = os.getenv('LOG_PROFILE', 'prod')
+    log_profiles = {'local': dict(level='DEBUG', row_sample_rate=1.0),
+                    'stage': dict(level='INFO', row_sample_rate=0.01),
+                    'prod': dict(level='INFO', row_sample_rate=0.0)}
+    enable_queue_logging = True
+
     def __init__(self):
         pass
 
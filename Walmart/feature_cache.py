@@ -0,0 +1,117 @@
+import datetime
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, Tuple
+
+from src.config import Settings
+from src.log_config import get_logger
+from src.metrics import register_cache
+
+# Set Logging Configurations
+logger = get_logger(__name__)
+
+
+class ClubItemFeatureCache():
+    """Bounded, thread safe, read-through cache for the club item rows fetched from the feature store.
+
+    Entries are keyed by (club_nbr, customer_item_nbr) and evicted in LRU order once max_size is reached. The feature
+    view is refreshed once a day, so an entry expires when the snapshot after its feature `date` is expected to be
+    published. If the feature store is lagging and that moment has already passed, the entry is kept for min_ttl
+    seconds so that the feature store is re-checked periodically instead of on every request.
+    """
+
+    def __init__(self, max_size: int, refresh_lag: int, min_ttl: int):
+        self.max_size = max_size
+        self.refresh_lag = refresh_lag
+        self.min_ttl = min_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_expiry(self, feature_date) -> float:
+        """Epoch time at which a row with the given feature date should stop being served.
+        :param feature_date: Date of the feature snapshot the row belongs to
+        :return:
+        """
+        now = time.time()
+        if feature_date is None:
+            return now + self.min_ttl
+        if isinstance(feature_date, datetime.datetime):
+            feature_date = feature_date.date()
+        next_snapshot = datetime.datetime.combine(feature_date + datetime.timedelta(days=1), datetime.time.min)
+        return max(next_snapshot.timestamp() + self.refresh_lag, now + self.min_ttl)
+
+    def get_many(self, keys: Iterable[Hashable]) -> Tuple[Dict[Hashable, dict], set]:
+        """Look up all the given keys in one go.
+        :param keys:
+        :return: Tuple of (rows found in the cache, keys which have to be fetched from the feature store)
+        """
+        found = {}
+        missing = set()
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                if key in found or key in missing:
+                    continue
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(key)
+                    # Callers get a copy so that nothing downstream can modify the cached row
+                    found[key] = dict(entry[1])
+                    self.hits += 1
+                else:
+                    if entry is not None:
+                        del self._entries[key]
+                    missing.add(key)
+                    self.misses += 1
+        return found, missing
+
+    def put_many(self, rows: Dict[Hashable, dict], feature_dates: Dict[Hashable, object]) -> None:
+        """Insert the rows fetched from the feature store.
+        :param rows: Key of the dict is (club_nbr, customer_item_nbr) and value is the club item row
+        :param feature_dates: Feature snapshot date of each row, used to compute the expiry
+        :return:
+        """
+        with self._lock:
+            for key, row in rows.items():
+                feature_date = feature_dates.get(key)
+                self._entries[key] = (self.get_expiry(feature_date), dict(row), feature_date)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_feature_dates(self, keys: Iterable[Hashable]) -> Dict[Hashable, object]:
+        """Feature snapshot date of the rows which would be served for the given keys. Unlike get_many, this doesn't
+        count as a lookup and doesn't change the LRU order.
+        :param keys:
+        :return: Key of the output dict is (club_nbr, customer_item_nbr) and value is the date, for the keys which have
+        an unexpired row with a known date
+        """
+        feature_dates = {}
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > now and entry[2] is not None:
+                    feature_dates[key] = entry[2]
+        return feature_dates
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(size=len(self._entries), max_size=self.max_size, hits=self.hits, misses=self.misses,
+                        evictions=self.evictions, hit_ratio=round(self.hits / lookups, 4) if lookups else 0.0)
+
+
+club_item_feature_cache = ClubItemFeatureCache(max_size=Settings.feature_cache_max_size,
+                                               refresh_lag=Settings.feature_cache_refresh_lag,
+                                               min_ttl=Settings.feature_cache_min_ttl)
+register_cache('club_item_features', club_item_feature_cache.stats)
@@ -0,0 +1,95 @@
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+from src.config import Settings
+from src.log_config import get_logger
+
+# Set Logging Configurations
+logger = get_logger(__name__)
+
+# Features which are derived from the feature snapshot date instead of being read from the Feature Store
+DATE_DERIVED_FEATURES = ['month', 'week']
+
+
+def build_club_item_feature_schema() -> Dict[str, np.dtype]:
+    """Declarative schema of the club item data, built from Settings.static_feature_names. Identifier and categorical
+    features are decoded as integers, rest of the features as floats.
+    :return: Key of the output dict is the column name and value is the numpy dtype it is decoded to
+    """
+    schema = {'item_nbr': np.dtype(np.int64)}
+    for feature in Settings.static_feature_names:
+        if feature in Settings.integer_feature_names:
+            schema[feature] = np.dtype(np.int64) if feature == 'club_nbr' else np.dtype(np.int32)
+        else:
+            schema[feature] = np.dtype(np.float64)
+    return schema
+
+
+club_item_feature_schema = build_club_item_feature_schema()
+
+
+class DecodedClubItemFeatures():
+    """Typed, columnar club item data indexed by (club_nbr, customer_item_nbr).
+
+    columns holds one numpy array per schema column. Integer values which could not be decoded are tracked in
+    valid_masks and are returned as None when rows are built, so that validate_pre_computed_features flags them.
+    """
+
+    def __init__(self, columns: Dict[str, np.ndarray], valid_masks: Dict[str, np.ndarray], feature_dates: list):
+        self.columns = columns
+        self.valid_masks = valid_masks
+        self.feature_dates = feature_dates
+        self.index = {(str(club_nbr), str(item_nbr)): position for position, (club_nbr, item_nbr) in
+                      enumerate(zip(columns['club_nbr'].tolist(), columns['item_nbr'].tolist()))}
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_rows(self) -> Dict[tuple, dict]:
+        """Builds the club item info dict for every indexed club item, in the format expected by the prediction
+        pipeline. Values are converted to python scalars column by column.
+        :return: Key of the output dict is (club_nbr, customer_item_nbr) and value is club item info
+        """
+        names = list(self.columns)
+        values = []
+        for name in names:
+            column_values = self.columns[name].tolist()
+            if name in self.valid_masks:
+                column_values = [value if is_valid else None for value, is_valid in
+                                 zip(column_values, self.valid_masks[name].tolist())]
+            values.append(column_values)
+        rows = [dict(zip(names, row_values)) for row_values in zip(*values)]
+        return {key: rows[position] for key, position in self.index.items()}
+
+    def get_feature_dates(self) -> Dict[tuple, object]:
+        return {key: self.feature_dates[position] for key, position in self.index.items()}
+
+
+def decode_club_item_features(club_item_data_df: pd.core.frame.DataFrame) -> DecodedClubItemFeatures:
+    """Decodes the DataFrame returned by the Feature Store in a single pass over its columns.
+
+    Rows without department_nbr are dropped. Missing values are set to 0 and non numeric values are coerced, integer
+    columns keep a mask of the values which could not be decoded. month and week are derived from the snapshot date.
+    :param club_item_data_df: Output of get_online_features(...).to_df()
+    :return:
+    """
+    club_item_data_df = club_item_data_df[club_item_data_df['department_nbr'].notna()]
+    feature_dates = pd.to_datetime(club_item_data_df['date'])
+    date_derived_columns = dict(month=feature_dates.dt.month, week=feature_dates.dt.isocalendar().week)
+
+    columns = {}
+    valid_masks = {}
+    for name, dtype in club_item_feature_schema.items():
+        series = date_derived_columns[name] if name in DATE_DERIVED_FEATURES else club_item_data_df[name]
+        values = pd.to_numeric(series.fillna(0), errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+        if dtype.kind == 'i':
+            is_valid = ~np.isnan(values)
+            if not is_valid.all():
+                valid_masks[name] = is_valid
+                values = np.where(is_valid, values, 0)
+        columns[name] = values.astype(dtype)
+
+    logger.info(f"Decoded {len(club_item_data_df)} club item rows from Feature Store data")
+    return DecodedClubItemFeatures(columns, valid_masks, feature_dates.dt.date.tolist())
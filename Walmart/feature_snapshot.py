@@ -0,0 +1,95 @@
+import os
+
+import pandas as pd
+
+from src.log_config import get_logger
+
+# Set Logging Configurations
+logger = get_logger(__name__)
+
+ENTITY_COLUMNS = ['club_nbr', 'item_nbr']
+
+
+def convert_to_arrow(path: str) -> str:
+    """Convert a Parquet snapshot to an Arrow IPC file next to it, batch by batch, unless an up to date one is there
+    already. The file is written under a temporary name and renamed, so a reader never sees it half written.
+    :return: Path of the Arrow file
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_path = os.path.splitext(path)[0] + '.arrow'
+    if os.path.isfile(arrow_path) and os.path.getmtime(arrow_path) >= os.path.getmtime(path):
+        return arrow_path
+    logger.info(f"Converting feature snapshot {path} to {arrow_path}")
+    parquet_file = pq.ParquetFile(path)
+    temp_path = f'{arrow_path}.{os.getpid()}.tmp'
+    try:
+        with pa.OSFile(temp_path, 'wb') as sink, pa.ipc.new_file(sink, parquet_file.schema_arrow) as writer:
+            for batch in parquet_file.iter_batches():
+                writer.write_batch(batch)
+        os.replace(temp_path, arrow_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return arrow_path
+
+
+class SnapshotFeatures():
+    """Result of SnapshotFeatureStore.get_online_features, mirrors the to_df() interface of the FeatureMart response"""
+
+    def __init__(self, table):
+        self.table = table
+
+    def to_df(self) -> pd.core.frame.DataFrame:
+        return self.table.to_pandas()
+
+
+class SnapshotFeatureStore():
+    """Feature backend serving club item features from a local daily snapshot of a feature view.
+
+    The snapshot is a Parquet file or an Arrow IPC file (.arrow/.feather) holding one row per club item with the
+    club_nbr and item_nbr entity columns and the feature columns. Arrow files are memory mapped, so the snapshot is
+    paged in on demand and shared by all the processes reading it. Parquet pages are compressed and encoded, they
+    can't be mapped: a Parquet snapshot is converted to an Arrow file next to it first (see convert_to_arrow). If that
+    directory can't be written to, the Parquet file is decoded into the memory of the process instead, and every
+    process reading it holds a copy of the whole table. Lookups are served from an in-memory
+    (club_nbr, item_nbr) -> row index built once at load time. The class exposes the same get_online_features method
+    RequestsManager calls on FeatureMart.
+    """
+
+    def __init__(self, path: str):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if not (path and os.path.isfile(path)):
+            raise FileNotFoundError(f"Feature snapshot not found: {path}")
+        self.path = path
+        if path.endswith('.parquet'):
+            try:
+                path = convert_to_arrow(path)
+            except OSError:
+                logger.warning(f"Feature snapshot {path} can't be converted to an Arrow file, loading it in memory",
+                               exc_info=True)
+        if path.endswith('.parquet'):
+            self.table = pq.read_table(path)
+        else:
+            self.table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+        self.index = {(str(club_nbr), str(item_nbr)): position for position, (club_nbr, item_nbr) in
+                      enumerate(zip(self.table.column('club_nbr').to_pylist(),
+                                    self.table.column('item_nbr').to_pylist()))}
+        logger.info(f"Loaded feature snapshot {path} with {len(self.index)} club items")
+
+    def get_online_features(self, entity_rows: list, features: list) -> SnapshotFeatures:
+        """Look up the given club items in the snapshot. Club items missing from the snapshot are left out of the
+        result.
+        :param entity_rows: List of dicts with club_nbr and item_nbr
+        :param features: Feature names in the '<feature_view>:<feature>' format used by FeatureMart
+        :return:
+        """
+        columns = ENTITY_COLUMNS + [feature.split(':')[-1] for feature in features
+                                    if feature.split(':')[-1] not in ENTITY_COLUMNS]
+        positions = [self.index[key] for key in
+                     ((str(entity['club_nbr']), str(entity['item_nbr'])) for entity in entity_rows)
+                     if key in self.index]
+        return SnapshotFeatures(self.table.select(columns).take(positions))
@@ -0,0 +1,142 @@
+"""
+Description - Gunicorn settings of the pre-fork multi-worker server mode.
+
+    python -m gunicorn -c python:src.gunicorn_conf src.app:app
+
+The app module is imported in the master (preload_app), along with the feature schema and the policy tables, and the
+model is loaded there before the workers are forked. Workers share these pages copy-on-write, so throughput scales with
+the number of workers while the model is kept in memory once.
+
+The master runs no thread, so that no lock is held when it forks. Every worker starts the process pool it runs large
+batches on as soon as it is forked, before it starts any thread of its own, and the pool processes are forked from
+it: they share the model with the master too. Its records are written from the calling thread and
+the model is refreshed from a SIGALRM handler, which runs in its main thread between two iterations of the arbiter loop.
+Once the new model is loaded, the master replaces the workers with ones forked from it, the same way as on a SIGHUP.
+
+Every worker has its own metrics registry and in-process caches. Metrics are served added up across the workers, see
+Settings.metrics_dir. Caches are not shared, so their hit ratio goes down as workers are added, which is reported by
+mdo_cache_lookups.
+"""
+
+import gc
+import math
+import os
+import signal
+import tempfile
+
+from src.config import Settings
+from src.jyotish.model_refresher import model_refresher
+from src.jyotish.prediction_pipeline import PredictionPipeline
+from src.jyotish.requests_manager import pipeline_process_pools
+from src.metrics import get_process_memory, metrics_registry
+from src.log_config import get_logger, write_directly
+
+write_directly()
+# Set Logging Configurations
+logger = get_logger(__name__)
+
+if Settings.metrics_dir is None:
+    # Set before the workers are forked, so that they all write to and are scraped from the same directory
+    Settings.metrics_dir = tempfile.mkdtemp(prefix='mdo_metrics_')
+
+
+def get_available_cpus() -> int:
+    """Cores the container may use, i.e. the CPU quota of its cgroup when there is one, else its CPU affinity"""
+    cpus = len(os.sched_getaffinity(0))
+    quota_files = [('/sys/fs/cgroup/cpu.max', None),
+                   ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu/cpu.cfs_period_us')]
+    for quota_file, period_file in quota_files:
+        try:
+            with open(quota_file) as file:
+                values = file.read().split()
+            if period_file is not None:
+                with open(period_file) as file:
+                    values += file.read().split()
+            quota, period = values[0], values[1]
+        except (OSError, IndexError):
+            continue
+        if quota not in ('max', '-1'):
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+        break
+    return cpus
+
+
+def log_memory_usage(process: str, pid: int) -> None:
+    memory = get_process_memory(pid)
+    logger.info(f"Memory of {process} {pid}: " +
+                ', '.join(f"{kind} {value / 2 ** 20:.1f} MiB" for kind, value in memory.items()))
+
+
+def freeze_shared_objects() -> None:
+    # Objects left to the garbage collector would have their pages written to by every collection in the workers,
+    # which copies them. Frozen objects are skipped by the collector and stay shared.
+    gc.collect()
+    gc.freeze()
+
+
+def schedule_model_refresh(seconds: float) -> None:
+    # signal.alarm takes whole seconds and 0 would cancel it
+    signal.alarm(max(1, math.ceil(seconds)))
+
+
+def refresh_model(signum, frame) -> None:
+    """SIGALRM handler of the master. The workers are only replaced once the new model is loaded, a failed load is
+    retried later while the workers keep serving the current one."""
+    try:
+        snapshot = model_refresher.load()
+    except Exception:
+        logger.error("Model refresh failed", exc_info=True)
+        schedule_model_refresh(Settings.model_refresh_retry_interval)
+        return
+    gc.unfreeze()
+    freeze_shared_objects()
+    schedule_model_refresh(model_refresher.get_seconds_to_refresh())
+    logger.info(f"Model {snapshot['model_version']} published, replacing the workers")
+    os.kill(os.getpid(), signal.SIGHUP)
+
+
+bind = Settings.server_bind
+workers = Settings.server_workers or get_available_cpus()
+worker_class = 'uvicorn.workers.UvicornWorker'
+preload_app = True
+timeout = Settings.server_timeout
+graceful_timeout = Settings.server_graceful_timeout
+
+
+def when_ready(server):
+    # The app module is imported by now, the workers are forked right after
+    if model_refresher.get_model_version() is None:
+        model_refresher.load()
+    freeze_shared_objects()
+    if Settings.enable_background_model_refresh:
+        signal.signal(signal.SIGALRM, refresh_model)
+        schedule_model_refresh(model_refresher.get_seconds_to_refresh())
+    # Reports the memory of the master along with the one of the workers
+    metrics_registry.write_snapshot(Settings.metrics_dir)
+    log_memory_usage('master', os.getpid())
+    logger.info(f"Starting {server.num_workers} workers")
+
+
+def post_fork(server, worker):
+    # The alarm is not inherited, only the master refreshes the model
+    model_refresher.detach()
+    # Cores are split between the workers, so is the process pool each of them runs large batches on
+    Settings.process_pool_workers = max(1, Settings.process_pool_workers // server.num_workers)
+    if Settings.enable_process_pool:
+        # Forked while the worker runs no thread, the Feature Store clients and the metrics writer start theirs below
+        model_data, model_version = model_refresher.get_model_data()
+        pipeline_process_pools.start_pool(PredictionPipeline.process_prediction_pipeline, model_data, model_version)
+    if Settings.feature_backend != 'snapshot':
+        # Feature Store clients hold network channels which don't survive a fork, every worker opens its own
+        import src.app as app_module
+        app_module.feature_store = app_module.create_feature_store()
+    metrics_registry.start_snapshot_writer(Settings.metrics_dir, Settings.metrics_snapshot_interval)
+
+
+def post_worker_init(worker):
+    log_memory_usage('worker', worker.pid)
+
+
+def worker_exit(server, worker):
+    # Counters and histograms of the worker keep being served once it exited
+    metrics_registry.write_snapshot(Settings.metrics_dir)
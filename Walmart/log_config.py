@@ -0,0 +1,125 @@
+"""
+Description - Centralized logging setup.
+
+Every module gets its logger from get_logger, which replaces the StreamHandler each module used to set up. Records are
+put on a queue by the request threads and written to the stream by a single background thread, so formatting and log
+I/O stay off the request path. Level and sampling come from the log profile of the environment (Settings.log_profile).
+"""
+
+import atexit
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+from src.config import Settings
+
+LOG_FORMAT = '%(asctime)s - [%(name)s] - [%(levelname)s] - %(message)s'
+
+# Passed as extra to the per row log lines, so that only row_sample_rate of them are kept
+ROW_SAMPLED = {'row_sampled': True}
+
+
+class LazyMessage():
+    """Log payload which is only built if the record is emitted, e.g. logger.debug("Sample: %s", LazyMessage(json.dumps,
+    data)). The function is called by the logging thread, so the data given to it must not be modified afterwards."""
+
+    def __init__(self, function, *args, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return str(self.function(*self.args, **self.kwargs))
+
+
+class RowSampleFilter(logging.Filter):
+    def __init__(self, row_sample_rate: float):
+        super().__init__()
+        self.row_sample_rate = row_sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, 'row_sampled', False) or self.row_sample_rate >= 1:
+            return True
+        return self.row_sample_rate > 0 and random.random() < self.row_sample_rate
+
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler which leaves the formatting of the record to the listener thread. The base class formats the
+    message in the calling thread, which would build the lazy payloads on the request path."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class DirectQueue():
+    """Stands in for the queue of the DeferredQueueHandler, handing the records straight to the stream handler"""
+
+    def __init__(self, handler: logging.Handler):
+        self.handler = handler
+
+    def put_nowait(self, record: logging.LogRecord) -> None:
+        self.handler.handle(record)
+
+
+def get_log_profile() -> dict:
+    return Settings.log_profiles.get(Settings.log_profile, Settings.log_profiles['prod'])
+
+
+def create_log_handler() -> logging.Handler:
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    if Settings.enable_queue_logging:
+        log_handler = DeferredQueueHandler(queue.SimpleQueue())
+    else:
+        log_handler = stream_handler
+    log_handler.addFilter(RowSampleFilter(get_log_profile()['row_sample_rate']))
+    log_handler.stream_handler = stream_handler
+    return log_handler
+
+
+def start_log_listener() -> None:
+    global log_listener
+    if isinstance(log_handler, QueueHandler):
+        log_listener = QueueListener(log_handler.queue, log_handler.stream_handler)
+        log_listener.start()
+
+
+def write_directly_in_child() -> None:
+    # The listener thread doesn't survive a fork and forked pool workers exit without running atexit, so workers write
+    # their records from the calling thread
+    global log_listener
+    if isinstance(log_handler, QueueHandler):
+        log_handler.queue = DirectQueue(log_handler.stream_handler)
+        log_listener = None
+
+
+def write_directly() -> None:
+    """Stop the listener thread and write the records from the calling thread. Used by processes which fork, so that
+    they run no thread when they do."""
+    if log_listener is not None:
+        log_listener.stop()
+    write_directly_in_child()
+
+
+def stop_log_listener() -> None:
+    # Flush the records still on the queue at exit
+    if log_listener is not None:
+        log_listener.stop()
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger of the given module, writing through the shared handler at the level of the log profile"""
+    logger = logging.getLogger(name)
+    logger.setLevel(get_log_profile()['level'])
+    if log_handler not in logger.handlers:
+        logger.addHandler(log_handler)
+    return logger
+
+
+log_listener = None
+log_handler = create_log_handler()
+start_log_listener()
+atexit.register(stop_log_listener)
+os.register_at_fork(after_in_child=write_directly_in_child)
@@ -0,0 +1,322 @@
+"""
+Description - In-process metrics registry exposed in the Prometheus text format on the /metrics route.
+
+Observations only update counters of the matching label set under a lock, all the formatting happens when /metrics is
+scraped. When Settings.enable_metrics is False, observations are dropped.
+
+In the pre-fork server mode every worker has its own registry and a scrape reaches one worker only. When
+Settings.metrics_dir is set, every process writes its values to a file of that directory every
+Settings.metrics_snapshot_interval seconds, and a scrape serves the values of all the files added up (counters and
+histograms of the workers which exited are kept, their gauges are dropped).
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from src.config import Settings
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BATCH_SIZE_BUCKETS = (1, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(label_names: tuple, label_values: tuple, extra: str = '') -> str:
+    labels = [f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter():
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        if not Settings.enable_metrics:
+            return
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get_values(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge_values(values_list: list) -> dict:
+        merged = {}
+        for values in values_list:
+            for key, value in values.items():
+                merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def collect(self, values: dict = None) -> list:
+        if values is None:
+            values = self.get_values()
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{format_labels(self.label_names, key)} {format_value(value)}')
+        return lines
+
+
+class Histogram():
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # Label values -> [count of each bucket (non cumulative, last one is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        if not Settings.enable_metrics:
+            return
+        key = tuple(labels[name] for name in self.label_names)
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            values[0][bucket_index] += 1
+            values[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the time taken by the body of the with statement, in seconds"""
+        starttime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - starttime, **labels)
+
+    def get_values(self) -> dict:
+        with self._lock:
+            return {key: (list(bucket_counts), total) for key, (bucket_counts, total) in self._values.items()}
+
+    @staticmethod
+    def merge_values(values_list: list) -> dict:
+        merged = {}
+        for values in values_list:
+            for key, (bucket_counts, total) in values.items():
+                if key in merged:
+                    merged_counts, merged_total = merged[key]
+                    bucket_counts = [count + merged_count for count, merged_count in zip(bucket_counts, merged_counts)]
+                    total += merged_total
+                merged[key] = (list(bucket_counts), total)
+        return merged
+
+    def collect(self, values: dict = None) -> list:
+        if values is None:
+            values = self.get_values()
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for key, (bucket_counts, total) in sorted(values.items()):
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip(self.buckets + ('+Inf',), bucket_counts):
+                cumulative_count += bucket_count
+                le = f'le="{format_value(upper_bound) if upper_bound != "+Inf" else upper_bound}"'
+                lines.append(f'{self.name}_bucket{format_labels(self.label_names, key, le)} {cumulative_count}')
+            lines.append(f'{self.name}_sum{format_labels(self.label_names, key)} {format_value(total)}')
+            lines.append(f'{self.name}_count{format_labels(self.label_names, key)} {cumulative_count}')
+        return lines
+
+
+class Gauge():
+    """Gauge whose values are read when /metrics is scraped. function returns the current value of every label set,
+    keyed by the tuple of label values."""
+
+    def __init__(self, name: str, documentation: str, label_names: tuple, function):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.function = function
+
+    def get_values(self) -> dict:
+        return self.function() if Settings.enable_metrics else {}
+
+    # Values of the same label set in several processes are added up
+    merge_values = staticmethod(Counter.merge_values)
+
+    def collect(self, values: dict = None) -> list:
+        if values is None:
+            values = self.get_values()
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{format_labels(self.label_names, key)} {format_value(value)}')
+        return lines
+
+
+class MetricsRegistry():
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, documentation: str, label_names: tuple = ()) -> Counter:
+        counter = Counter(name, documentation, label_names)
+        self.metrics.append(counter)
+        return counter
+
+    def histogram(self, name: str, documentation: str, label_names: tuple = (),
+                  buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        histogram = Histogram(name, documentation, label_names, buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def gauge(self, name: str, documentation: str, label_names: tuple, function) -> Gauge:
+        gauge = Gauge(name, documentation, label_names, function)
+        self.metrics.append(gauge)
+        return gauge
+
+    def render(self) -> str:
+        """All the metrics in the Prometheus text exposition format"""
+        if Settings.metrics_dir is None:
+            return '\n'.join(line for metric in self.metrics for line in metric.collect()) + '\n'
+        # The values of this process are written first, so that they are up to date in the scrape
+        self.write_snapshot(Settings.metrics_dir)
+        snapshots = read_snapshots(Settings.metrics_dir)
+        return '\n'.join(line for metric in self.metrics for line in metric.collect(
+            metric.merge_values([snapshot.get(metric.name, {}) for snapshot in snapshots]))) + '\n'
+
+    def write_snapshot(self, directory: str) -> None:
+        """Write the values of this process to its file in directory. The file is replaced atomically, so that a
+        scrape never reads a partial one."""
+        snapshot = dict(pid=os.getpid(), metrics={
+            metric.name: [[list(key), value] for key, value in metric.get_values().items()] for metric in self.metrics})
+        path = os.path.join(directory, f'metrics_{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as file:
+            json.dump(snapshot, file)
+        os.replace(path + '.tmp', path)
+
+    def start_snapshot_writer(self, directory: str, interval: float) -> None:
+        """Write the values of this process to directory every interval seconds, on a daemon thread"""
+        def write_snapshots():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write_snapshot(directory)
+                except OSError:
+                    pass
+
+        threading.Thread(target=write_snapshots, name='metrics_snapshot_writer', daemon=True).start()
+
+
+def is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_snapshots(directory: str) -> list:
+    """Values written to directory by every process, as a list of {metric name: {label values: value}}"""
+    gauges = set(metric.name for metric in metrics_registry.metrics if isinstance(metric, Gauge))
+    snapshots = []
+    for file_name in os.listdir(directory):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, file_name)) as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            continue
+        alive = is_process_alive(snapshot['pid'])
+        snapshots.append({name: {tuple(key): value for key, value in values}
+                          for name, values in snapshot['metrics'].items() if alive or name not in gauges})
+    return snapshots
+
+
+metrics_registry = MetricsRegistry()
+
+request_latency = metrics_registry.histogram(
+    'mdo_request_duration_seconds', 'Time taken to serve a batch, including the time spent queued',
+    ('endpoint',))
+stage_latency = metrics_registry.histogram(
+    'mdo_stage_duration_seconds', 'Time taken by a pipeline stage for a batch', ('pipeline', 'stage'))
+batch_size = metrics_registry.histogram(
+    'mdo_batch_size', 'Number of requests in a batch', ('endpoint',), buckets=BATCH_SIZE_BUCKETS)
+batch_requests = metrics_registry.counter(
+    'mdo_batch_requests_total', 'Number of requests received in batches', ('endpoint',))
+no_reco_reason_codes = metrics_registry.counter(
+    'mdo_no_reco_reason_code_total', 'Number of requests by the no_reco_reason_code of their output',
+    ('endpoint', 'no_reco_reason_code'))
+
+process_memory = metrics_registry.gauge(
+    'mdo_process_memory_bytes', 'Memory of the serving process. pss counts the pages shared with the other workers '
+    'pro rata, so the pss of all the workers adds up to their footprint.', ('pid', 'kind'),
+    lambda: {(str(os.getpid()), kind): value for kind, value in get_process_memory().items()})
+
+# Stats functions of the in-process caches, see register_cache
+cache_stats = {}
+cache_lookups = metrics_registry.gauge(
+    'mdo_cache_lookups', 'Lookups of the in-process caches by result. Every server worker has its own caches, so the '
+    'hit ratio goes down as workers are added.', ('cache', 'result'),
+    lambda: {(name, result): stats()[result] for name, stats in cache_stats.items() for result in ('hits', 'misses')})
+cache_entries = metrics_registry.gauge(
+    'mdo_cache_entries', 'Number of entries of the in-process caches', ('cache',),
+    lambda: {(name,): stats()['size'] for name, stats in cache_stats.items()})
+
+
+def register_cache(name: str, stats) -> None:
+    """Serve the hits, misses and size returned by the stats function of a cache on /metrics"""
+    cache_stats[name] = stats
+
+
+def get_process_memory(pid='self') -> dict:
+    """Memory of a process in bytes, from /proc/<pid>/smaps_rollup: rss, pss, shared and private. Only rss is known
+    where smaps_rollup is not available, and nothing outside of Linux.
+    """
+    fields = {'Rss': 'rss', 'Pss': 'pss', 'Shared_Clean': 'shared', 'Shared_Dirty': 'shared',
+              'Private_Clean': 'private', 'Private_Dirty': 'private'}
+    memory = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as file:
+            lines = file.readlines()
+    except OSError:
+        fields = {'VmRSS': 'rss'}
+        try:
+            with open(f'/proc/{pid}/status') as file:
+                lines = file.readlines()
+        except OSError:
+            return memory
+    for line in lines:
+        name, _, value = line.partition(':')
+        if name in fields:
+            # Values are given in kB
+            memory[fields[name]] = memory.get(fields[name], 0) + int(value.split()[0]) * 1024
+    return memory
+
+
+def observe_batch(endpoint: str, size: int) -> None:
+    batch_size.observe(size, endpoint=endpoint)
+    batch_requests.inc(size, endpoint=endpoint)
+
+
+def count_no_reco_reason_codes(endpoint: str, output: dict) -> None:
+    """Count the no_reco_reason_code of every request in the output of an endpoint"""
+    if not Settings.enable_metrics:
+        return
+    counts = {}
+    for value in output.values():
+        no_reco_reason_code = value.get('no_reco_reason_code') if isinstance(value, dict) else None
+        if no_reco_reason_code is not None:
+            counts[no_reco_reason_code] = counts.get(no_reco_reason_code, 0) + 1
+    for no_reco_reason_code, count in counts.items():
+        no_reco_reason_codes.inc(count, endpoint=endpoint, no_reco_reason_code=no_reco_reason_code)
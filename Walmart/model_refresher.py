@@ -0,0 +1,107 @@
+import datetime
+import threading
+import time
+from typing import Tuple
+
+from src.config import Settings
+from src.jyotish.model_loader import model_loader_handle
+from src.log_config import get_logger
+
+# Set Logging Configurations
+logger = get_logger(__name__)
+
+
+class ModelRefresher():
+    """Keeps a loaded copy of the model and its features off the request path.
+
+    The model is preloaded at startup and reloaded by a background thread every Settings.model_ttl seconds. The
+    refresh is scheduled Settings.model_refresh_delay seconds after the TTL of the loader runs out, so that the loader
+    really downloads the new model, and it happens on the background thread only since requests never call the
+    loader. The new model, its features and version are published together by swapping a single reference, so a
+    request always sees a consistent set and keeps serving the previous model while the next one is loading.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self._snapshot = None
+        self._next_refresh_at = None
+        self._load_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._detached = False
+
+    def load(self) -> dict:
+        """Load the model and features from the loader and publish them.
+        :return: The published snapshot
+        """
+        with self._load_lock:
+            starttime = time.perf_counter()
+            all_features, categorical_features = self.loader.get_features()
+            model = self.loader.get_model()
+            loaded_at = datetime.datetime.now()
+            model_version = getattr(self.loader, 'model_version', None) or loaded_at.strftime("%Y%m%dT%H%M%S")
+            model_data = dict(all_features=all_features, categorical_features=categorical_features, model=model)
+            snapshot = self.publish(model_data, str(model_version))
+            logger.info(f"Model {model_version} loaded in {time.perf_counter() - starttime:.2f} seconds")
+            return snapshot
+
+    def publish(self, model_data: dict, model_version: str) -> dict:
+        """Make the given model data the one served to the requests.
+        :param model_data: Dict with all_features, categorical_features and model
+        :param model_version:
+        :return: The published snapshot
+        """
+        snapshot = dict(model_data=model_data, model_version=model_version)
+        self._snapshot = snapshot
+        self._next_refresh_at = time.time() + Settings.model_ttl + Settings.model_refresh_delay
+        return snapshot
+
+    def get_seconds_to_refresh(self) -> float:
+        """Seconds till the model is due to be reloaded, 0 if it is due already"""
+        if self._next_refresh_at is None:
+            return 0
+        return max(0, self._next_refresh_at - time.time())
+
+    def get_model_data(self) -> Tuple[dict, str]:
+        """Model data in the format expected by the pipeline processors, along with the model version. Only the very
+        first call loads the model inline, and only if it was not preloaded.
+        :return:
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self.load()
+        return snapshot['model_data'], snapshot['model_version']
+
+    def get_model_version(self):
+        """Version of the model currently served, None if no model is loaded yet. Never loads the model."""
+        snapshot = self._snapshot
+        return snapshot['model_version'] if snapshot is not None else None
+
+    def start(self) -> None:
+        """Preload the model and start the background refresh thread"""
+        if self._snapshot is None:
+            self.load()
+        if Settings.enable_background_model_refresh and not self._detached and self._thread is None:
+            self._thread = threading.Thread(target=self._refresh_loop, name='model_refresher', daemon=True)
+            self._thread.start()
+
+    def detach(self) -> None:
+        """Keep serving the published snapshot without refreshing it. Called in the server workers forked from a master
+        which refreshes the model, the master replaces the workers when it publishes a new one."""
+        self._detached = True
+        self._thread = None
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def _refresh_loop(self) -> None:
+        while not self._stop_event.wait(self.get_seconds_to_refresh()):
+            try:
+                self.load()
+            except Exception:
+                # Keep serving the current model and try again later
+                self._next_refresh_at = time.time() + Settings.model_refresh_retry_interval
+                logger.error("Background model refresh failed", exc_info=True)
+
+
+model_refresher = ModelRefresher(model_loader_handle)
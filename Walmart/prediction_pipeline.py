@@ -1,18 +1,13 @@
 import traceback
-import logging
 
 import pandas as pd
 
 from src.jyotish.data_model import ItemClub, ItemClubElasticity
 from src.jyotish.data_validation import DataValidationManager, ElasticityDataValidationManager
 from src.jyotish.sale_predictor import SalePredictor, ElasticityPredictor
+from src.log_config import get_logger, ROW_SAMPLED
 
-logger = logging.getLogger(__name__)
-handler = logging.StreamHandler()
-logger.setLevel(logging.INFO)
-format_ = logging.Formatter('%(asctime)s - [%(name)s] - [%(levelname)s] - %(message)s')
-handler.setFormatter(format_)
-logger.addHandler(handler)
+logger = get_logger(__name__)
 
 
 class PredictionPipeline():
@@ -23,7 +18,7 @@ class PredictionPipeline():
         if not club_item_data:
             return False, "Item-Club combination does not have enough sales data"
 
-        logger.info("validating pre computed features")
+        logger.debug("validating pre computed features", extra=ROW_SAMPLED)
 
         validation_failure_messages = []
         if not (isinstance(club_item_data.get('club_nbr'), int)):
@@ -94,7 +89,7 @@ class PredictionPipeline():
             model_features = {}
         op_generated = dict(outlier=outlier, expected_sale_units=expected_sale_units, model_features=model_features,
                             remark=remark)
-        logger.info(f"Output data formatted")
+        logger.debug("Output data formatted", extra=ROW_SAMPLED)
         formatted_output.update(op_generated)
         return formatted_output
 
@@ -114,6 +109,18 @@ class PredictionPipeline():
                                 model_features=model_features, remark=remark)
         return formatted_output
 
+    def screen_elasticity_request(club_item_data: dict) -> dict:
+        """
+        Output of process_elasticity_prediction_pipeline for a request whose pre computed features fail validation, or
+        None if they pass. Callers whose input is already validated answer these requests without building them.
+        :param club_item_data:
+        :return:
+        """
+        validation_status, validation_message = PredictionPipeline.validate_pre_computed_features(club_item_data)
+        if validation_status:
+            return None
+        return PredictionPipeline.format_elasticity_output('incomplete_info', remark=validation_message)
+
     # FIXME: Define input and output data types for all the functions. Write documentation of all functions
     def process_prediction_pipeline(input_data: ItemClub, club_item_data: dict, model_data: dict) -> dict:
         """
@@ -125,13 +132,13 @@ class PredictionPipeline():
         try:
             validation_handle = DataValidationManager(input_data)
             validation_status, validation_message = validation_handle.validate_input_data()
-            logger.info(f"Input data validation Status: {validation_status}")
+            logger.debug("Input data validation Status: %s", validation_status, extra=ROW_SAMPLED)
 
             output = None
             if validation_status:
                 validation_status, validation_message = PredictionPipeline.validate_pre_computed_features(
                     club_item_data)
-                logger.info(f"Pre computed data validation Status: {validation_status}")
+                logger.debug("Pre computed data validation Status: %s", validation_status, extra=ROW_SAMPLED)
 
                 if validation_status:
                     sale_predictor_handle = SalePredictor(input_data, club_item_data, model_data)
@@ -147,7 +154,7 @@ class PredictionPipeline():
                 output = PredictionPipeline.format_output(input_data, "invalid_input", remark=validation_message)
 
             op_validation_status, op_validation_message = validation_handle.validate_output_data(output)
-            logger.info(op_validation_message)
+            logger.debug(op_validation_message, extra=ROW_SAMPLED)
 
             if op_validation_status:
                 return output
@@ -1,25 +1,106 @@
 import json
-import logging
 import math
+import multiprocessing
+import threading
+import time
 
 import pandas as pd
-import numpy as np
-from typing import Dict, Union
-# from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Dict, Tuple, Union
 
 from src.azure_connection import get_connection
 from src.jyotish.data_model import ItemClub, ItemClubElasticity
-from src.jyotish.model_loader import model_loader_handle
+from src.jyotish.feature_cache import club_item_feature_cache
+from src.jyotish.feature_decoder import decode_club_item_features
+from src.jyotish.model_refresher import model_refresher
 from src.config import Settings
+from src.metrics import stage_latency
+from src.log_config import get_logger, LazyMessage
 import os
 
 # Set Logging Configurations
-logger = logging.getLogger(__name__)
-handler = logging.StreamHandler()
-logger.setLevel(logging.INFO)
-format_ = logging.Formatter('%(asctime)s - [%(name)s] - [%(levelname)s] - %(message)s')
-handler.setFormatter(format_)
-logger.addHandler(handler)
+logger = get_logger(__name__)
+
+# Shared across requests so that the number of concurrent Feature Store calls stays bounded
+feature_fetch_executor = ThreadPoolExecutor(max_workers=Settings.feature_fetch_max_workers,
+                                            thread_name_prefix='feature_fetch')
+
+# Pipeline processor and model data of a process pool worker, set once by its initializer instead of being sent with
+# every task
+_pool_pipeline_processor = None
+_pool_model_data = None
+
+
+def run_pipeline_processor(pipeline_processor, requests: list, club_item_data_vals: list, model_data: dict) -> list:
+    """Run the pipeline processor on the given requests, one by one, in the current process.
+    :return: Pipeline processor output for each request, in the same order as the requests
+    """
+    return list(map(pipeline_processor, requests, club_item_data_vals, [model_data] * len(requests)))
+
+
+def _init_pool_worker(pipeline_processor, model_data: dict) -> None:
+    global _pool_pipeline_processor, _pool_model_data
+    _pool_pipeline_processor = pipeline_processor
+    _pool_model_data = model_data
+
+
+def _run_pool_pipeline_processor(chunk: tuple) -> list:
+    requests, club_item_data_vals = chunk
+    return run_pipeline_processor(_pool_pipeline_processor, requests, club_item_data_vals, _pool_model_data)
+
+
+class PipelineProcessPools():
+    """Long lived process pools, one per pipeline processor, which run large batches.
+
+    In the pre-fork server mode, every server worker starts its pool with start_pool right after it is forked from the
+    preloaded master and before it runs any thread. The pool processes are forked from it as well, so they share the
+    model data copy-on-write with the master instead of holding a copy each, and nothing is pickled.
+
+    A pool started later on, by get_pool, is started from a process whose threads (logging, executors, Feature Store
+    fetches) may hold locks, which can deadlock forked children. Its processes are started by the forkserver, a single
+    threaded process of its own, and every one of them receives its own copy of the model data in its initializer: the
+    model is then held process_pool_workers + 1 times. This is the case of the single process server, and of any
+    model version change, on which the pool of a pipeline processor is replaced. Batches already running on the
+    previous pool finish on it.
+    """
+
+    def __init__(self):
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _start_pool(self, start_method: str, pipeline_processor, model_data: dict, model_version: str):
+        _, pool = self._pools.get(pipeline_processor, (None, None))
+        if pool is not None:
+            pool.close()
+        logger.info(f"Starting a process pool of {Settings.process_pool_workers} processes for model {model_version} "
+                    f"({start_method})")
+        pool = multiprocessing.get_context(start_method).Pool(
+            processes=Settings.process_pool_workers, initializer=_init_pool_worker,
+            initargs=(pipeline_processor, model_data))
+        self._pools[pipeline_processor] = (model_version, pool)
+        return pool
+
+    def start_pool(self, pipeline_processor, model_data: dict, model_version: str) -> None:
+        """Start the pool of the pipeline processor by forking the current process, which must not run any thread yet"""
+        with self._lock:
+            self._start_pool('fork', pipeline_processor, model_data, model_version)
+
+    def get_pool(self, pipeline_processor, model_data: dict, model_version: str):
+        with self._lock:
+            pool_version, pool = self._pools.get(pipeline_processor, (None, None))
+            if pool is None or pool_version != model_version:
+                pool = self._start_pool('forkserver', pipeline_processor, model_data, model_version)
+            return pool
+
+    def close(self) -> None:
+        with self._lock:
+            for _, pool in self._pools.values():
+                pool.close()
+            self._pools.clear()
+
+
+pipeline_process_pools = PipelineProcessPools()
 
 
 class RequestsManager():
@@ -27,19 +108,80 @@ class RequestsManager():
         self.requests_data = data
         self.pipeline_processor = pipeline_processor
         self.feature_store = feature_store
+        self.model_version = None
+        # Requests given as columns by from_columns, requests_data is left empty then
+        self.request_ids = None
+        self.request_columns = None
+        self.request_model = None
+
+    @classmethod
+    def from_columns(cls, request_ids: list, columns: Dict[str, list], request_model, pipeline_processor,
+                     feature_store) -> 'RequestsManager':
+        """Take the requests straight from columns of Python values already validated by in-process callers (e.g. the
+        V3 pipeline), instead of going through JSON. Club items are looked up from the columns, and request objects are
+        only built for the requests handed to the pipeline processor, see process_requests_as_columns.
+        :param request_ids:
+        :param columns: Field name of the request model mapped to the values of all the requests, in request_ids order
+        :param request_model: ItemClub or ItemClubElasticity. Requests are built with parse_obj, so field values are
+        validated and coerced the same way as the ones of a JSON request.
+        :return:
+        """
+        requests_manager = cls({}, pipeline_processor, feature_store)
+        requests_manager.request_ids = list(request_ids)
+        requests_manager.request_columns = columns
+        requests_manager.request_model = request_model
+        return requests_manager
+
+    def get_request_club_items(self) -> Dict[str, tuple]:
+        """(club_nbr, customer_item_nbr) of every request, keyed by request_id"""
+        if self.request_columns is not None:
+            return dict(zip(self.request_ids, zip(self.request_columns['club_nbr'],
+                                                  self.request_columns['customer_item_nbr'])))
+        return {request_id: (input_data.club_nbr, input_data.customer_item_nbr)
+                for request_id, input_data in self.requests_data.items()}
 
     def get_distinct_club_items(self) -> set:
-        club_items = set((input_data.club_nbr, input_data.customer_item_nbr)
-                         for input_data in self.requests_data.values())
-        return club_items
+        return set(self.get_request_club_items().values())
 
     def get_club_item_data(self) -> Dict[str, dict]:
-        """Fetches Databricks data for all the club items in the input request.
+        """Fetches the club item info for all the club items in the input request. Rows present in the feature cache
+        are served from memory and only the remaining club items are pulled from the Feature Store.
         :return: Key of the output dict is request_id and value is club item info
         """
+        # Several requests can point to the same club item, so every distinct club item is looked up only once and
+        # the row is fanned back out to all its request_ids at the end
+        request_club_items = self.get_request_club_items()
+        club_items = set(request_club_items.values())
+        if club_items:
+            logger.info(f"{len(request_club_items)} requests map to {len(club_items)} distinct club items "
+                        f"(dedup ratio {len(request_club_items) / len(club_items):.2f})")
+        if Settings.enable_feature_cache:
+            club_item_rows, missing_keys = club_item_feature_cache.get_many(club_items)
+        else:
+            club_item_rows, missing_keys = {}, club_items
+        logger.info(f"Feature cache lookup: {len(club_item_rows)} club items found, {len(missing_keys)} to be fetched")
+
+        if missing_keys:
+            fetched_rows, feature_dates = self.fetch_club_item_data(missing_keys)
+            if Settings.enable_feature_cache:
+                club_item_feature_cache.put_many(fetched_rows, feature_dates)
+            club_item_rows.update(fetched_rows)
+
+        if Settings.enable_feature_cache:
+            logger.info(f"Feature cache stats: {club_item_feature_cache.stats()}")
+
+        return {request_id: club_item_rows.get(key, {}) for request_id, key in request_club_items.items()}
+
+    def fetch_club_item_data(self, club_items: set) -> Tuple[Dict[tuple, dict], Dict[tuple, object]]:
+        """Fetches Feature Store data for the given club items.
+        :param club_items: Distinct (club_nbr, customer_item_nbr) pairs which have to be fetched
+        :return: Tuple of two dicts, both keyed by (club_nbr, customer_item_nbr). First one contains the club item info
+        and second one the date of the feature snapshot the info belongs to.
+        """
 
         logger.info("Pulling from Feature Store")
-        Settings.setup_feature_store_credentials()
+        if Settings.feature_backend == 'feature_mart':
+            Settings.setup_feature_store_credentials()
 
         fv = "sams_club_item_daily_v4"
 
@@ -53,83 +195,158 @@ class RequestsManager():
         feature_names.remove(f'{fv}:club_nbr')
         feature_names.append(f'{fv}:date')
 
-        entity_rows = [{'item_nbr': input_data.customer_item_nbr,
-                        'club_nbr': input_data.club_nbr}
-                       for input_data in self.requests_data.values()]
+        entity_rows = [{'item_nbr': customer_item_nbr,
+                        'club_nbr': club_nbr}
+                       for club_nbr, customer_item_nbr in sorted(club_items)]
         logger.info("Store Entity created. Get Online Features func being called.")
-        club_item_data_df = self.feature_store.get_online_features(
-            entity_rows=entity_rows,
-            features=feature_names
-        ).to_df()
-        club_item_data_df = club_item_data_df[club_item_data_df['department_nbr'].notna()]
-        logger.info(club_item_data_df.columns)
-
-        club_item_data_df['date'] = pd.to_datetime(club_item_data_df['date'])
-        club_item_data_df['month'] = club_item_data_df['date'].dt.month
-        club_item_data_df['week'] = club_item_data_df['date'].dt.isocalendar().week
-        club_item_data_df = club_item_data_df.drop('date', axis=1)
-
-        club_item_data_df = club_item_data_df.fillna(value=np.nan)
-        datatype_dict = club_item_data_df.dtypes.to_dict()
-        club_item_data_df = club_item_data_df.fillna(0)
-        club_item_data_df = club_item_data_df.astype(datatype_dict)
-        
-        logger.info(club_item_data_df.head().to_string())
-        
-        integer_columns, _ = model_loader_handle.get_features()
-        integer_columns = list(set(integer_columns) & set(club_item_data_df.columns))
-        club_item_data_df[integer_columns] = club_item_data_df[integer_columns].apply(pd.to_numeric, errors='coerce')
-        club_item_data_df['department_nbr'] = club_item_data_df['department_nbr'].astype('Int64')
-        club_item_data_df['subclass_nbr'] = club_item_data_df['subclass_nbr'].astype('Int64')
-        club_item_data_df['unit_sold_1_week_back_cnt'] = club_item_data_df['unit_sold_1_week_back_cnt'].astype('float')
-        club_item_data_df['unit_sold_2_week_back_cnt'] = club_item_data_df['unit_sold_2_week_back_cnt'].astype('float')
-        club_item_data_df['unit_sold_3_week_back_cnt'] = club_item_data_df['unit_sold_3_week_back_cnt'].astype('float')
-        club_item_data_df['unit_sold_4_week_back_cnt'] = club_item_data_df['unit_sold_4_week_back_cnt'].astype('float')
-
-        logger.info("Sample data fetched from Featurestore:\n" + club_item_data_df.head().to_string())
-        # Assumption: club_nbr or customer_item_nbr doesn't contain '__' in its value
-        club_item_data_dict = {str(x['club_nbr']) + '__' + str(x['item_nbr']): x for x in
-                               club_item_data_df.to_dict(orient='records')}
-        club_item_data = {}
-        for request_id, input_data in self.requests_data.items():
-            key = input_data.club_nbr + '__' + input_data.customer_item_nbr
-            club_item_data[request_id] = club_item_data_dict.get(key, {})
-        return club_item_data
-
-    def process_requests(self) -> Dict[str, dict]:
-        """Fetch club item info for all the club items in one go and then call the prediction pipeline for each request
-        one by one.
+        with stage_latency.time(pipeline='jyotish', stage='feature_fetch'):
+            if Settings.enable_chunked_feature_fetch and len(entity_rows) > Settings.feature_fetch_chunk_size:
+                club_item_data_df = self.get_online_features_in_chunks(entity_rows, feature_names)
+            else:
+                club_item_data_df = self.feature_store.get_online_features(
+                    entity_rows=entity_rows,
+                    features=feature_names
+                ).to_df()
+        with stage_latency.time(pipeline='jyotish', stage='feature_decode'):
+            decoded_features = decode_club_item_features(club_item_data_df)
+        return decoded_features.get_rows(), decoded_features.get_feature_dates()
+
+    def get_online_features_with_retry(self, entity_rows: list, feature_names: list) -> pd.core.frame.DataFrame:
+        """Fetches one chunk of entity rows from the Feature Store, retrying with a linear backoff on failure.
+        :return: Feature Store data for the chunk
+        """
+        for attempt in range(Settings.feature_fetch_max_retries + 1):
+            try:
+                return self.feature_store.get_online_features(
+                    entity_rows=entity_rows,
+                    features=feature_names
+                ).to_df()
+            except Exception:
+                if attempt == Settings.feature_fetch_max_retries:
+                    raise
+                logger.warning(f"Feature Store fetch failed for a chunk of {len(entity_rows)} club items "
+                               f"(attempt {attempt + 1}). Retrying.", exc_info=True)
+                time.sleep(Settings.feature_fetch_retry_backoff * (attempt + 1))
+
+    def get_online_features_in_chunks(self, entity_rows: list, feature_names: list) -> pd.core.frame.DataFrame:
+        """Splits the entity rows into chunks of Settings.feature_fetch_chunk_size and fetches them concurrently on
+        the feature fetch thread pool. Chunks are merged back in the order of the entity rows. If a chunk still fails
+        after all the retries, its club items are left out (those requests end up as incomplete_info) instead of
+        failing the whole batch.
+        :return: Feature Store data for all the entity rows
+        """
+        chunk_size = Settings.feature_fetch_chunk_size
+        chunks = [entity_rows[i:i + chunk_size] for i in range(0, len(entity_rows), chunk_size)]
+        logger.info(f"Fetching {len(entity_rows)} club items in {len(chunks)} chunks")
+        futures = [feature_fetch_executor.submit(self.get_online_features_with_retry, chunk, feature_names)
+                   for chunk in chunks]
+        chunk_dfs = []
+        last_error = None
+        for chunk_index, future in enumerate(futures):
+            try:
+                chunk_dfs.append(future.result())
+            except Exception as e:
+                last_error = e
+                logger.error(f"Feature Store fetch failed for chunk {chunk_index} of {len(chunks)}, skipping its "
+                             f"{len(chunks[chunk_index])} club items", exc_info=True)
+        if not chunk_dfs:
+            raise last_error
+        return pd.concat(chunk_dfs, ignore_index=True)
+
+    def run_pipeline_processor_in_pool(self, requests: tuple, club_item_data_vals: list, model_data: dict) -> list:
+        """Run the pipeline processor on all the requests with the process pool of the pipeline processor. The pipeline
+        processor and the model data are given to the workers when the pool starts, so only the request and its club
+        item info travel to the workers with every task.
+        :return: Pipeline processor output for each request, in the same order as the requests
+        """
+        pool = pipeline_process_pools.get_pool(self.pipeline_processor, model_data, self.model_version)
+        num_processes = min(Settings.process_pool_workers, len(requests))
+        chunksize = Settings.process_pool_chunk_size or math.ceil(len(requests) / (num_processes * 4))
+        logger.info(f"Doing multiprocessing with {num_processes} processes and chunksize {chunksize}")
+        chunks = [(requests[i:i + chunksize], club_item_data_vals[i:i + chunksize])
+                  for i in range(0, len(requests), chunksize)]
+        chunk_results = pool.map(_run_pool_pipeline_processor, chunks, 1)
+        return [result for results in chunk_results for result in results]
+
+    def process_requests(self, club_item_data: Dict[str, dict] = None) -> Dict[str, dict]:
+        """Fetch club item info for all the club items in one go and then call the prediction pipeline for each request.
+        Large batches are spread over a process pool.
+        :param club_item_data: Output of get_club_item_data, if it has already been fetched by the caller
         :return: Expected sale results for all the requests.
         """
         if not len(self.requests_data):
             return {}
-        logger.info("Sample input Data")
-        logger.info(json.dumps([val.dict() for val in self.requests_data.values()][:2], sort_keys=True, indent=4))
-        logger.info("Fetching Club Item data from Feature Store")
+        sample_input = [val.dict() for val in islice(self.requests_data.values(), 2)]
+        logger.debug("Sample input Data:\n%s", LazyMessage(json.dumps, sample_input, sort_keys=True, indent=4))
 
-        club_item_data = self.get_club_item_data()
+        if club_item_data is None:
+            logger.info("Fetching Club Item data from Feature Store")
+            club_item_data = self.get_club_item_data()
         key_vals = list(zip(*self.requests_data.items()))
         # key_vals is a list of size 2. 1st element of key_vals is the tuple of request_ids and 2nd element is tuple of
         # requests
         request_ids = key_vals[0]
         requests = key_vals[1]
         club_item_data_vals = [club_item_data[request_id] for request_id in request_ids]
+        results = self.run_requests(requests, club_item_data_vals)
+        return dict(zip(request_ids, results))
 
-        # Fetching model and features data
-        all_features, categorical_features = model_loader_handle.get_features()
-        model = model_loader_handle.get_model()
-        model_data = dict(all_features=all_features, categorical_features=categorical_features, model=model)
+    def run_requests(self, requests: list, club_item_data_vals: list) -> list:
+        """Call the prediction pipeline for each request, on the process pool for large batches.
+        :return: Pipeline processor output for each request, in the same order as the requests
+        """
+        # Fetching model and features data. The model is kept loaded and refreshed in the background by model_refresher
+        model_data, self.model_version = model_refresher.get_model_data()
 
         logger.info("Running prediction pipeline on all the requests")
-        results = list(map(self.pipeline_processor, requests, club_item_data_vals, [model_data] * len(requests)))
-        # # results = list(map(self.pipeline_processor, requests, club_item_data_vals, [model_data] * len(requests)))
-        # pipeline_processor_args = list(zip(requests, club_item_data_vals, [model_data] * len(requests)))
-        # # num_processes = min(max(1, math.ceil(os.cpu_count() - 2)), len(requests))
-        # num_processes = min(2, len(requests))
-        # logger.info(f"Doing multiprocessing with {num_processes} processes")
-        # chunksize = math.ceil(len(requests) / num_processes)
-        # with Pool(processes=num_processes, maxtasksperchild=chunksize) as pool:
-        #     results = pool.starmap(self.pipeline_processor, pipeline_processor_args, chunksize)
+        with stage_latency.time(pipeline='jyotish', stage='inference'):
+            if Settings.enable_process_pool and len(requests) >= Settings.process_pool_min_batch_size:
+                results = self.run_pipeline_processor_in_pool(requests, club_item_data_vals, model_data)
+            else:
+                results = run_pipeline_processor(self.pipeline_processor, requests, club_item_data_vals, model_data)
         logger.info('Prediction pipeline completed')
-        return dict(zip(request_ids, results))
+        return results
+
+    def process_request_columns(self, club_item_data: Dict[str, dict] = None, screen_request=None) -> list:
+        """process_requests for the requests given as columns to from_columns. Requests which screen_request answers
+        from their club item info never go through the pipeline processor, request objects are only built for the
+        other ones.
+        :return: Output of each request, in the order of request_ids
+        """
+        if not self.request_ids:
+            return []
+        fields = list(self.request_columns)
+        sample_input = [{field: self.request_columns[field][row] for field in fields}
+                        for row in range(min(2, len(self.request_ids)))]
+        logger.debug("Sample input Data:\n%s", LazyMessage(json.dumps, sample_input, sort_keys=True, indent=4))
 
+        if club_item_data is None:
+            logger.info("Fetching Club Item data from Feature Store")
+            club_item_data = self.get_club_item_data()
+        club_item_data_vals = [club_item_data[request_id] for request_id in self.request_ids]
+        results = [None if screen_request is None else screen_request(row_data) for row_data in club_item_data_vals]
+        rows = [row for row, result in enumerate(results) if result is None]
+        logger.info(f"{len(rows)} of {len(results)} requests go through the prediction pipeline")
+        if not rows:
+            self.model_version = model_refresher.get_model_version()
+            return results
+        requests = [self.request_model.parse_obj({field: self.request_columns[field][row] for field in fields})
+                    for row in rows]
+        for row, result in zip(rows, self.run_requests(requests, [club_item_data_vals[row] for row in rows])):
+            results[row] = result
+        return results
+
+    def process_requests_as_columns(self, club_item_data: Dict[str, dict] = None,
+                                    screen_request=None) -> Dict[str, list]:
+        """Same as process_requests, with the results returned column wise for in-process callers.
+        :param club_item_data: Output of get_club_item_data, if it has already been fetched by the caller
+        :param screen_request: Only used for requests given by from_columns. Called with the club item info of every
+        request, returns the output of a request which doesn't need the pipeline processor and None otherwise.
+        :return: Each output field mapped to its values for all the requests, in the order of the requests
+        """
+        if self.request_columns is not None:
+            results = self.process_request_columns(club_item_data, screen_request)
+        else:
+            results = list(self.process_requests(club_item_data).values())
+        fields = dict.fromkeys(field for result in results for field in result)
+        return {field: [result.get(field) for result in results] for field in fields}
@@ -0,0 +1,26 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import src.app as app_module
+
+
+@pytest.fixture
+def full_stream_limiter(monkeypatch):
+    """Limiter of the streaming endpoint with its only slot taken by a batch in flight and no room in the queue"""
+    limiter = app_module.EndpointLimiter('v3_stream', max_concurrency=1, max_queued=0)
+    monkeypatch.setitem(app_module.endpoint_limiters, 'v3_stream', limiter)
+    slot = limiter.limit()
+    asyncio.run(slot.__aenter__())
+    yield limiter
+    asyncio.run(slot.__aexit__(None, None, None))
+
+
+def test_stream_is_rejected_with_503_when_the_limiter_is_full(full_stream_limiter):
+    client = TestClient(app_module.app)
+    body = b'{"request_id": "r1", "club_nbr": "8299"}\n'
+    response = client.post('/ndjson/v3', content=body, headers={'Content-Type': 'application/x-ndjson'})
+    assert response.status_code == 503
+    assert response.headers['content-type'].startswith('application/json')
+    assert full_stream_limiter.waiting == 0
@@ -0,0 +1,118 @@
+import copy
+import datetime
+import random
+
+import pandas as pd
+import pytest
+
+from src.config import Settings
+from src.v3.calendar_context import CalendarContext
+from src.v3.data_model import ItemClub
+from src.v3.data_validation import (format_output_as_dict, validate_input, validate_input_batch, validate_output,
+                                    validate_output_batch)
+
+CALENDAR = CalendarContext(datetime.date(2026, 10, 19))
+
+
+def get_date(days: int) -> str:
+    return (CALENDAR.today + datetime.timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+def generate_input_frame(seed: int, num_rows: int = 500) -> pd.core.frame.DataFrame:
+    """Inputs the way the pipeline builds them, with every validation rule failing on some of the rows"""
+    rng = random.Random(seed)
+    rows = []
+    for request_id in range(num_rows):
+        current_retail_price = rng.choice([10.0, 7.99, 3.0, 0.0, -1.0])
+        rows.append(dict(request_id=str(request_id),
+                         club_nbr=rng.choice(['8299'] * 9 + [8299]),
+                         customer_item_nbr=rng.choice(['980254364'] * 9 + [None]),
+                         oos_date=rng.choice([get_date(rng.randint(-5, 70)), '2026-13-01', '20261101']),
+                         md_start_date=rng.choice([None, None, get_date(rng.randint(-3, 60)), '2026-02-30']),
+                         sell_through_threshold=rng.choice([None, 0.0, 0.5, 1.0, 1.5, -0.1]),
+                         current_inventory=rng.choice([0, -3, 1, 20, 100]),
+                         current_retail_price=current_retail_price,
+                         liquidation_price=rng.choice([0.0, 2.5, -1.0, current_retail_price + 1])))
+    data = (pd.DataFrame(rows)
+            .assign(no_reco_reason_code='recommendation_successful', remark='')
+            .convert_dtypes())
+    # Dates which can't be parsed along with an md_start_date make validate_cross_features raise, see
+    # validate_input_batch
+    dates_parsed = (pd.to_datetime(data['md_start_date'], format="%Y-%m-%d", errors='coerce').notna() &
+                    pd.to_datetime(data['oos_date'], format="%Y-%m-%d", errors='coerce').notna())
+    return data[data['md_start_date'].isna() | dates_parsed]
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('enable_historic_data_requests', [False, True])
+def test_validate_input_batch_matches_validate_input(seed, enable_historic_data_requests, monkeypatch):
+    monkeypatch.setattr(Settings, 'enable_historic_data_requests', enable_historic_data_requests)
+    data = generate_input_frame(seed)
+    expected = data.apply(validate_input, axis=1, calendar=CALENDAR)
+    result = validate_input_batch(data, CALENDAR)
+    assert result['remark'].tolist() == expected['remark'].tolist()
+    assert result['no_reco_reason_code'].tolist() == expected['no_reco_reason_code'].tolist()
+    assert (result['no_reco_reason_code'] == 'invalid_input').any()
+
+
+@pytest.mark.parametrize('expected_sale_units, expected', [
+    ([0.0, 3.7, None], [0.0, 3, None]),
+    ([0.0, 3.0, None], [0, 3, None]),
+])
+def test_format_output_keeps_zero_sales_as_floats_unless_all_sales_are_whole(expected_sale_units, expected):
+    data = pd.DataFrame(dict(request_id=['r1', 'r2', 'r3'], expected_sale_units=expected_sale_units))
+    result = format_output_as_dict(data, CALENDAR)
+    sales = [output['expected_sale_units'] for output in result.values()]
+    assert sales == expected
+    assert list(map(type, sales)) == list(map(type, expected))
+
+
+def generate_output(rng: random.Random, input_data: ItemClub) -> dict:
+    """Output of a club item, either a valid recommendation or one breaking some of the output rules"""
+    output = {column: None for column in Settings.output_cols}
+    output.update(input_data.dict(), no_reco_reason_code='recommendation_successful', remark='')
+    if rng.random() < 0.1:
+        output.update(no_reco_reason_code=rng.choice(['invalid_input', 'unknown_code']),
+                      remark=rng.choice(['', None, 'Some remark']))
+        return output
+    price = input_data.current_retail_price
+    num_weeks = (CALENDAR.get_date(input_data.oos_date) - CALENDAR.today).days // 7 + 1
+    output['markdown_recommendation'] = [dict(
+        markdown_session_start_date=get_date(rng.choice([0, 1, 2, 2, 2, 60])),
+        recommended_markdown_price=rng.choice([round(price * 0.7, 2), round(price * 0.6, 1), 2.81, 4.99, price + 1]))]
+    output['expected_sale_units'] = rng.choice([rng.randint(0, input_data.current_inventory), 5.0, -1, None,
+                                                input_data.current_inventory + 1])
+    output['week_level_expected_sale_units'] = [
+        dict(start_date=get_date(7 * week), end_date=get_date(7 * week + 6) if week < num_weeks - 1 else
+             input_data.oos_date, expected_sale_units=rng.choice([0.0, 0.1, 0.3, None, -0.5]))
+        for week in range(num_weeks)]
+    output['expected_revenue'] = rng.choice([rng.uniform(0, price * input_data.current_inventory), -1.0, None])
+    output['model_features'] = rng.choice([{'department_nbr': rng.choice([1, '22', 5, 40, '71'])}] * 5 + [{}, None])
+    if rng.random() < 0.05:
+        output['week_level_expected_sale_units'][0]['start_date'] = '2026-13-01'
+    if rng.random() < 0.05:
+        output['current_inventory'] += 1
+    return output
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_validate_output_batch_matches_validate_output(seed):
+    rng = random.Random(seed)
+    input_data = {}
+    for request_id in range(500):
+        current_retail_price = rng.choice([10.0, 12.5, 7.99, 3.0])
+        input_data[f'r{request_id}'] = ItemClub(
+            club_nbr=str(rng.randint(1, 5)), customer_item_nbr=str(request_id), oos_date=get_date(rng.randint(20, 55)),
+            md_start_date=rng.choice([None, get_date(2)]), sell_through_threshold=rng.choice([None, 0.5]),
+            current_inventory=rng.randint(1, 100), current_retail_price=current_retail_price,
+            liquidation_price=rng.choice([0.0, 1.0, 2.5]))
+    output_data = {request_id: generate_output(rng, item_club) for request_id, item_club in input_data.items()}
+    # Outputs missing for some of the inputs, along with one no input was given for
+    for request_id in rng.sample(sorted(output_data), 10):
+        del output_data[request_id]
+    output_data['extra'] = dict(next(iter(output_data.values())))
+
+    expected = validate_output(input_data, copy.deepcopy(output_data), CALENDAR)
+    result = validate_output_batch(input_data, copy.deepcopy(output_data), CALENDAR)
+    assert result == expected
+    assert any(output['no_reco_reason_code'] == 'unexpected_error' for output in expected.values())
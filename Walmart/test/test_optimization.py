@@ -0,0 +1,110 @@
+import datetime
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.config import Settings
+from src.v3.calendar_context import CalendarContext
+from src.v3.elasticity_tensor import ElasticityTensor
+from src.v3.optimization import get_optimal_points
+
+CALENDAR = CalendarContext(datetime.date(2026, 10, 19))
+
+OUTPUT_COLUMNS = ['markdown_recommendation', 'expected_sale_units', 'expected_revenue',
+                  'week_level_expected_sale_units', 'no_reco_reason_code', 'remark']
+
+
+def generate_elasticity_data(rng: random.Random, current_inventory: int) -> pd.core.frame.DataFrame:
+    """Elasticity curves of a club item, with price points spread over a few markdown start dates. Prices and units are
+    drawn from small sets, so that revenue ties happen, and a few price points have no session."""
+    first_date = datetime.date(2026, 10, 20)
+    rows = []
+    for _ in range(rng.randint(1, 24)):
+        num_sessions = rng.choice([0, 1, 1, 2, 2, 3, 3])
+        start_date = first_date + datetime.timedelta(days=7 * rng.randint(0, 7))
+        dividing_dates = [(start_date + datetime.timedelta(days=7 * session)).strftime("%Y-%m-%d")
+                          for session in range(num_sessions - 1)]
+        units = [rng.choice([0.0, 1.0, 2.5, 4.0, 10.0]) * current_inventory / 20 for _ in range(num_sessions)]
+        rows.append(dict(session_level_units_sold=units,
+                         session_prices=[rng.choice([4.0, 5.5, 6.25, 7.0, 9.99]) for _ in range(num_sessions)],
+                         session_dividing_dates=dividing_dates,
+                         week_level_units_sold=[rng.random() for _ in range(rng.randint(0, 8))]))
+    return pd.DataFrame(rows)
+
+
+def generate_batch(seed: int, num_rows: int = 300) -> pd.core.frame.DataFrame:
+    rng = random.Random(seed)
+    rows = []
+    for request_id in range(num_rows):
+        current_inventory = rng.choice([10, 20, 50])
+        rows.append(dict(request_id=str(request_id),
+                         elasticity_data=generate_elasticity_data(rng, current_inventory),
+                         current_inventory=current_inventory,
+                         liquidation_price=rng.choice([0.0, 1.0, 2.5]),
+                         sell_through_threshold=rng.choice([None, 0.1, 0.5, 0.9]),
+                         no_reco_reason_code='recommendation_successful',
+                         remark=''))
+    data = pd.DataFrame(rows)
+    # Curves of the batch are stacked once, the way get_expected_sale does
+    return data.assign(elasticity_curve=ElasticityTensor.from_frames(list(data['elasticity_data'])).get_curves())
+
+
+def test_optimal_points_of_a_subset_of_the_batch():
+    # StageExecutor hands the optimizer only the rows which are still successful, their curves are taken out of the
+    # tensor of the whole batch
+    data = generate_batch(0)
+    subset = data.iloc[::3]
+    expected = get_optimal_points(data)[OUTPUT_COLUMNS].iloc[::3]
+    assert get_optimal_points(subset)[OUTPUT_COLUMNS].to_dict('records') == expected.to_dict('records')
+
+
+def get_optimal_point(club_item_data: pd.core.series.Series, calendar: CalendarContext) -> pd.core.series.Series:
+    """Row-wise optimizer which get_optimal_points replaced, kept as the reference of its selection rules"""
+    elasticity_data = club_item_data['elasticity_data']
+    current_inventory = club_item_data['current_inventory']
+    liquidation_price = club_item_data['liquidation_price']
+    input_stt = club_item_data['sell_through_threshold']
+    sell_through_threshold = Settings.default_sell_through_threshold if pd.isna(input_stt) else input_stt
+    max_revenue_data = (
+        elasticity_data
+        .assign(expected_sale_units=lambda x: x['session_level_units_sold'].apply(sum))
+        .assign(expected_sell_through=lambda x: x['expected_sale_units'] / current_inventory)
+        .assign(sell_through_threshold=lambda x: min(max(x['expected_sell_through']), sell_through_threshold))
+        .query("expected_sell_through >= sell_through_threshold")
+        .assign(expected_liquidation_sale=lambda x: current_inventory - x['expected_sale_units'])
+        .assign(expected_revenue=lambda x: x.apply(
+            lambda y: np.dot(y['session_level_units_sold'], y['session_prices']) +
+            y['expected_liquidation_sale'] * liquidation_price, axis=1))
+        .loc[lambda x: x['expected_revenue'] == x['expected_revenue'].max()]
+        .loc[lambda x: x['session_prices'].map(tuple) == tuple(x['session_prices'].max())]
+        .loc[lambda x: x['session_dividing_dates'].map(tuple) == tuple(x['session_dividing_dates'].min())]
+    )
+    session_dividing_dates = max_revenue_data.iloc[0]['session_dividing_dates']
+    recommended_md_start_date = session_dividing_dates[0] if session_dividing_dates else calendar.today_str
+    club_item_data['markdown_recommendation'] = [dict(
+        markdown_session_start_date=recommended_md_start_date,
+        recommended_markdown_price=max_revenue_data.iloc[0]['session_prices'][-1])]
+    club_item_data['expected_sale_units'] = max_revenue_data.iloc[0]['expected_sale_units']
+    club_item_data['expected_revenue'] = max_revenue_data.iloc[0]['expected_revenue']
+    club_item_data['week_level_expected_sale_units'] = max_revenue_data.iloc[0]['week_level_units_sold']
+    return club_item_data
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_optimal_points_match_the_row_wise_optimizer(seed):
+    data = generate_batch(seed, num_rows=500)
+    result = get_optimal_points(data, CALENDAR)
+    for (_, row), (_, output) in zip(data.iterrows(), result.iterrows()):
+        try:
+            expected = get_optimal_point(row.copy(), CALENDAR)
+        except IndexError:
+            # No price point could be selected, or the selected one has no session
+            assert output['no_reco_reason_code'] == 'unexpected_error'
+            continue
+        assert output['no_reco_reason_code'] == 'recommendation_successful'
+        assert output['markdown_recommendation'] == expected['markdown_recommendation']
+        assert output['expected_sale_units'] == expected['expected_sale_units']
+        assert output['expected_revenue'] == expected['expected_revenue']
+        assert list(output['week_level_expected_sale_units']) == list(expected['week_level_expected_sale_units'])